@@ -15,19 +15,28 @@ from __future__ import annotations
 
 import sys
 import os
+import functools
+import http
+import base64
+import re
 import json
 import queue
 import threading
 import time
 import subprocess
-from typing import Optional, List, Dict
+from collections import deque
+from itertools import groupby
+from typing import Optional, List, Dict, NamedTuple
 
 # Windows 控制台 UTF-8
 if sys.platform == "win32":
     try:
         sys.stdout.reconfigure(encoding="utf-8")
         sys.stderr.reconfigure(encoding="utf-8")
-        os.system("chcp 65001 >nul 2>nul")
+        # 进程内设置控制台代码页，代替启动 cmd.exe 执行 chcp
+        import ctypes
+        ctypes.windll.kernel32.SetConsoleOutputCP(65001)
+        ctypes.windll.kernel32.SetConsoleCP(65001)
     except Exception:
         pass
 
@@ -37,8 +46,19 @@ try:
 except ImportError:
     pass
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 from loguru import logger
 import lark_oapi
+from lark_oapi.ws.enum import MessageType
+from lark_oapi.ws.const import HEADER_MESSAGE_ID, HEADER_TRACE_ID, HEADER_SUM, HEADER_SEQ, HEADER_TYPE, HEADER_BIZ_RT
+from lark_oapi.ws.model import Response
+from lark_oapi.core.const import UTF_8
+from lark_oapi.core.json import JSON
+from lark_oapi.api.im.v1 import CreateMessageRequest, CreateMessageRequestBody
 
 # ==================== 配置 ====================
 APP_ID = os.environ.get("FEISHU_APP_ID", "").strip()
@@ -51,28 +71,45 @@ MY_ADMIN_ID = os.environ.get("FEISHU_MY_ADMIN_OPEN_ID", "").strip()
 CLAUDE_PATH = os.environ.get("CLAUDE_PATH", r"C:\Users\yq\.local\bin\claude.exe").strip()
 WORK_DIR = os.environ.get("WORK_DIR", r"D:\ceshi_python\Claudecode-feishu").strip()
 PROCESS_NAME = os.environ.get("CLAUDE_PROCESS_NAME", "claude.exe").strip()
+# 额外按 WM_PASTE 直接粘贴的窗口类名（英文逗号分隔），用于支持该消息的终端
+WM_PASTE_EXTRA_CLASSES = os.environ.get("CLAUDE_WM_PASTE_CLASSES", "").strip()
+
+# ==================== JSON 序列化 ====================
+# 安装了 orjson 时优先使用（更快），否则回退到标准库 json
+def _json_dumps(obj) -> str:
+    """序列化为紧凑 JSON 字符串（保留非 ASCII 字符）"""
+    if orjson is not None:
+        return orjson.dumps(obj).decode('utf-8')
+    return json.dumps(obj, ensure_ascii=False, separators=(',', ':'))
+
+
+def _json_dumps_bytes(obj) -> bytes:
+    """序列化为紧凑的单行 UTF-8 JSON 字节串（可一次 write 写入）"""
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS)
+    return json.dumps(obj, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+
+# 解析 JSON 字符串或字节串（直接绑定实现，热路径上不再判断 orjson 是否可用）
+_json_loads = orjson.loads if orjson is not None else json.loads
+
 
 # 工作区持久化配置
 WORKSPACE_PERSIST_FILE = os.environ.get("WORKSPACE_PERSIST_FILE", "workspace_persist.json").strip()
+# 持久化文件路径（使用 app.py 所在目录，启动时计算一次）
+_PERSIST_FILE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), WORKSPACE_PERSIST_FILE)
 
 # ==================== 多工作区持久化 ====================
-def _get_persist_file_path() -> str:
-    """获取持久化文件路径"""
-    # 使用 app.py 所在目录
-    base_dir = os.path.dirname(os.path.abspath(__file__))
-    return os.path.join(base_dir, WORKSPACE_PERSIST_FILE)
-
-
 def _load_workspace_persist():
     """加载工作区会话持久化"""
-    persist_file = _get_persist_file_path()
+    persist_file = _PERSIST_FILE_PATH
     if not os.path.exists(persist_file):
         logger.info("未找到工作区持久化文件，将创建新文件")
         return {}
 
     try:
-        with open(persist_file, 'r', encoding='utf-8') as f:
-            data = json.load(f)
+        with open(persist_file, 'rb') as f:
+            data = _json_loads(f.read())
             logger.info(f"已加载工作区持久化数据: {len(data.get('workspace_chat_map', {}))} 个群聊映射")
             return data
     except Exception as e:
@@ -80,53 +117,117 @@ def _load_workspace_persist():
         return {}
 
 
+class _PersistWriter:
+    """工作区持久化的延迟写入器
+
+    热路径只标记 dirty，由后台线程在 FLUSH_INTERVAL 秒内合并多次变更后统一落盘，
+    写入时先写同目录 .tmp 文件再 os.replace，避免写到一半崩溃导致文件损坏。
+    """
+    FLUSH_INTERVAL = 1.5  # 秒
+
+    def __init__(self):
+        self._event = threading.Event()
+        self._write_lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+        self._thread_lock = threading.Lock()
+        self.last_dirty_ts: float = 0
+
+    def mark_dirty(self):
+        """标记需要保存，由后台线程延迟写入"""
+        self.last_dirty_ts = time.monotonic()
+        # 多个线程都会调用：双重检查加锁，保证只启动一个写入线程
+        if self._thread is None:
+            with self._thread_lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._run, name="persist-writer", daemon=True)
+                    self._thread.start()
+        self._event.set()
+
+    def _run(self):
+        while True:
+            self._event.wait()
+            time.sleep(self.FLUSH_INTERVAL)
+            self._event.clear()
+            self._write()
+
+    def flush_sync(self):
+        """立即同步写入（程序退出时调用）"""
+        self._event.clear()
+        self._write()
+
+    def _write(self):
+        persist_file = _PERSIST_FILE_PATH
+        tmp_file = persist_file + ".tmp"
+        with self._write_lock:
+            try:
+                data = _workspace_manager.get_persist_data()
+                with open(tmp_file, 'wb') as f:
+                    f.write(_json_dumps_bytes(data))
+                os.replace(tmp_file, persist_file)
+                logger.debug("已保存工作区持久化数据")
+            except Exception as e:
+                logger.warning(f"保存工作区持久化失败: {e}")
+
+
+_persist_writer = _PersistWriter()
+
+
 def _save_workspace_persist():
-    """保存工作区会话持久化"""
-    persist_file = _get_persist_file_path()
-    try:
-        data = _workspace_manager.get_persist_data()
-        with open(persist_file, 'w', encoding='utf-8') as f:
-            json.dump(data, f, ensure_ascii=False, indent=2)
-        logger.debug("已保存工作区持久化数据")
-    except Exception as e:
-        logger.warning(f"保存工作区持久化失败: {e}")
+    """保存工作区会话持久化（延迟合并写入）"""
+    _persist_writer.mark_dirty()
 
 
 # ==================== 多工作目录管理 ====================
 _workspaces: List[dict] = []  # 工作目录列表 [{"name": "xxx", "path": "xxx"}, ...]
 _current_workspace_index: int = 0  # 当前工作目录索引
 _admin_open_id_detected: bool = False  # 是否已检测到 admin open_id
+# 自动发现工作区的缓存（父目录 mtime 未变且未超过 TTL 时不重新扫描）
+_WORKSPACES_CACHE_TTL = 30  # 秒
+_workspaces_cache_ts: float = 0.0
+_workspaces_cache_parent_mtime: float = 0.0
+# WORK_DIRS / WORK_DIR 模式下解析结果对应的配置字符串（未变化时直接复用列表）
+_workspaces_cache_src: Optional[str] = None
+# 工作区名称 -> 索引、按索引排列的名称元组（均随 load_workspace_configs 重建）
+_workspace_name_index: Dict[str, int] = {}
+_workspace_names: tuple = ()
+_workspace_name_index_src: Optional[List[dict]] = None  # 构建索引时对应的工作区列表
+
+
+# 匹配 .env 中的 FEISHU_CURRENT_CHAT_ID 行，group(1) 为值
+_ENV_CHAT_ID_RE = re.compile(rb'^[ \t]*FEISHU_CURRENT_CHAT_ID[ \t]*=[ \t]*(.*?)[ \t]*\r?$', re.M)
 
 
 def update_workspace_env_chat_id(workspace_dir: str, chat_id: str):
-    """更新工作区 .env 文件中的 CHAT_ID"""
+    """更新工作区 .env 文件中的 CHAT_ID（只改写该行，其余内容保持不变）"""
     if not workspace_dir or not chat_id:
         return
 
     env_file = os.path.join(workspace_dir, ".env")
     key = "FEISHU_CURRENT_CHAT_ID"
+    new_value = chat_id.encode('utf-8')
 
     try:
-        # 读取现有配置
-        env_vars = {}
+        data = b""
         if os.path.exists(env_file):
-            with open(env_file, 'r', encoding='utf-8') as f:
-                for line in f:
-                    line = line.strip()
-                    if line and not line.startswith('#') and '=' in line:
-                        k, v = line.split('=', 1)
-                        env_vars[k.strip()] = v.strip()
-
-        # 更新 CHAT_ID
-        old_chat_id = env_vars.get(key, "")
-        if old_chat_id != chat_id:
-            env_vars[key] = chat_id
-            # 写回文件
-            with open(env_file, 'w', encoding='utf-8') as f:
-                f.write("# 自动更新的 chat_id\n")
-                for k, v in env_vars.items():
-                    f.write(f"{k}={v}\n")
-            logger.info(f"已更新工作区 .env 中的 {key}: {chat_id}")
+            with open(env_file, 'rb') as f:
+                data = f.read()
+
+        m = _ENV_CHAT_ID_RE.search(data)
+        if m:
+            # 值未变化，无需写入
+            if m.group(1) == new_value:
+                return
+            data = data[:m.start(1)] + new_value + data[m.end(1):]
+        else:
+            if data and not data.endswith(b"\n"):
+                data += b"\n"
+            data += key.encode('utf-8') + b"=" + new_value + b"\n"
+
+        tmp_file = env_file + ".tmp"
+        with open(tmp_file, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_file, env_file)
+        logger.info(f"已更新工作区 .env 中的 {key}: {chat_id}")
     except Exception as e:
         logger.warning(f"更新工作区 .env 失败: {e}")
 
@@ -153,8 +254,23 @@ def detect_and_prompt_admin_open_id(open_id: str):
 
 
 def load_workspace_configs() -> List[dict]:
+    """从环境变量加载多工作目录配置，并在列表变化时重建名称索引"""
+    global _workspace_name_index, _workspace_name_index_src, _workspace_names
+    workspaces = _load_workspace_configs()
+    if _workspace_name_index_src is not workspaces:
+        index: Dict[str, int] = {}
+        for i, ws in enumerate(workspaces):
+            # 同名时保留第一个
+            index.setdefault(ws["name"], i)
+        _workspace_name_index = index
+        _workspace_names = tuple(ws["name"] for ws in workspaces)
+        _workspace_name_index_src = workspaces
+    return workspaces
+
+
+def _load_workspace_configs() -> List[dict]:
     """从环境变量加载多工作目录配置"""
-    global _workspaces
+    global _workspaces, _workspaces_cache_ts, _workspaces_cache_parent_mtime, _workspaces_cache_src
 
     # 检查是否启用自动发现工作区
     auto_discover = os.environ.get("WORK_DIRS_AUTO_DISCOVER", "").strip().lower()
@@ -162,14 +278,22 @@ def load_workspace_configs() -> List[dict]:
         # 自动发现：扫描父目录下的所有子目录
         parent_dir = os.environ.get("WORK_DIRS_PARENT_DIR", "").strip()
         if parent_dir and os.path.isdir(parent_dir):
+            parent_mtime = os.stat(parent_dir).st_mtime
+            if (_workspaces
+                    and time.monotonic() - _workspaces_cache_ts < _WORKSPACES_CACHE_TTL
+                    and parent_mtime == _workspaces_cache_parent_mtime):
+                return _workspaces
+
             _workspaces = []
-            for entry in os.listdir(parent_dir):
-                dir_path = os.path.join(parent_dir, entry)
-                if os.path.isdir(dir_path):
+            _workspaces_cache_src = None
+            with os.scandir(parent_dir) as it:
+                for entry in it:
                     # 跳过隐藏目录和特殊目录
-                    if not entry.startswith('.') and not entry.startswith('_'):
-                        _workspaces.append({"name": entry, "path": dir_path})
+                    if entry.is_dir() and not entry.name.startswith(('.', '_')):
+                        _workspaces.append({"name": entry.name, "path": entry.path})
             if _workspaces:
+                _workspaces_cache_ts = time.monotonic()
+                _workspaces_cache_parent_mtime = parent_mtime
                 logger.info(f"自动发现 {len(_workspaces)} 个工作区:")
                 for ws in _workspaces:
                     logger.info(f"  - {ws['name']}: {ws['path']}")
@@ -178,6 +302,9 @@ def load_workspace_configs() -> List[dict]:
     # 优先使用 WORK_DIRS（逗号分隔的多个目录）
     work_dirs_str = os.environ.get("WORK_DIRS", "").strip()
     if work_dirs_str:
+        src = "WORK_DIRS=" + work_dirs_str
+        if _workspaces and _workspaces_cache_src == src:
+            return _workspaces
         dir_list = [d.strip() for d in work_dirs_str.split(",") if d.strip()]
         _workspaces = []
         for dir_path in dir_list:
@@ -187,15 +314,21 @@ def load_workspace_configs() -> List[dict]:
         logger.info(f"Loaded {len(_workspaces)} workspaces")
         for ws in _workspaces:
             logger.info(f"  - {ws['name']}: {ws['path']}")
+        _workspaces_cache_src = src
         return _workspaces
 
     # 兼容旧版：使用单个 WORK_DIR
     if WORK_DIR:
+        src = "WORK_DIR=" + WORK_DIR
+        if _workspaces and _workspaces_cache_src == src:
+            return _workspaces
         _workspaces = [{"name": os.path.basename(WORK_DIR.rstrip("\\/")) or WORK_DIR, "path": WORK_DIR}]
         logger.info(f"使用单个工作目录: {_workspaces[0]['name']}")
+        _workspaces_cache_src = src
         return _workspaces
 
     _workspaces = []
+    _workspaces_cache_src = None
     return _workspaces
 
 
@@ -216,6 +349,7 @@ def switch_workspace(index: int, chat_id: str = None) -> bool:
     global _current_workspace_index
     if 0 <= index < len(_workspaces):
         _current_workspace_index = index
+        _invalidate_workspace_card()
         ws = get_current_workspace()
         logger.info(f"已切换到工作目录: {ws['name']}")
 
@@ -236,9 +370,8 @@ def get_workspace_display_text() -> str:
 
     current = get_current_workspace()
     lines = [f"**当前目录**: {current['name']}", "", "**可选目录**:", ""]
-    for i, ws in enumerate(_workspaces):
-        prefix = "👉 " if i == _current_workspace_index else "   "
-        lines.append(f"{prefix}{i + 1}. {ws['name']}")
+    cur = _current_workspace_index
+    lines.extend(f"{'👉 ' if i == cur else '   '}{i + 1}. {name}" for i, name in enumerate(_workspace_names))
     return "\n".join(lines)
 
 # ==================== 多工作区独立进程管理 ====================
@@ -249,22 +382,81 @@ class WorkspaceManager:
         self._workspace_senders: Dict[int, ProcessInputSender] = {}  # index -> sender
         self._workspace_pids: Dict[int, int] = {}  # index -> pid
         self._workspace_chat_map: Dict[str, int] = {}  # chat_id -> workspace_index
+        # index -> (待注入文本队列, 唤醒事件)；多生产者 append、单消费者 popleft，GIL 下原子无需加锁
+        self._send_queues: Dict[int, tuple] = {}
+        self._send_threads: Dict[int, threading.Thread] = {}  # index -> 注入 worker 线程
         self._lock = threading.Lock()
+        # 剪贴板和前台窗口是全局资源，多个工作区的注入需串行执行
+        self._inject_lock = threading.Lock()
+
+    SEND_QUEUE_MAXSIZE = 100
+    # 一次注入最多合并的消息数及消息间分隔
+    INJECT_BATCH_MAX = 8
+    INJECT_SEPARATOR = "\n\n---\n\n"
+
+    def _ensure_send_worker(self, index: int) -> tuple:
+        """确保工作区的注入 worker 线程已启动（需在 self._lock 内调用）"""
+        entry = self._send_queues.get(index)
+        if entry is None:
+            entry = (deque(), threading.Event())
+            self._send_queues[index] = entry
+            t = threading.Thread(target=self._send_worker, args=(index, *entry),
+                                 name=f"ws-sender-{index}", daemon=True)
+            self._send_threads[index] = t
+            t.start()
+        return entry
+
+    def _send_worker(self, index: int, dq: deque, ev: threading.Event):
+        """工作区注入 worker：依次取出文本并注入到对应 Claude Code 窗口"""
+        while True:
+            ev.wait()
+            ev.clear()
+            while dq:
+                # 合并连续到达的同一 chat_id 的消息为一次注入（最多 INJECT_BATCH_MAX 条，保证响应及时）；
+                # 不同群聊的消息分开注入，避免回复路由依赖 Claude 区分同一段粘贴中的多个标记
+                chat_id, text = dq.popleft()
+                texts = [text]
+                while dq and len(texts) < self.INJECT_BATCH_MAX and dq[0][0] == chat_id:
+                    texts.append(dq.popleft()[1])
+                try:
+                    sender = self.get_sender_for_workspace(index)
+                    if not sender:
+                        logger.error(f"工作区 {index} 的 sender 不存在，丢弃 {len(texts)} 条消息")
+                        continue
+                    with self._inject_lock:
+                        ok = sender.execute(self.INJECT_SEPARATOR.join(texts))
+                    if ok:
+                        logger.info(f"✅ {len(texts)} 条消息已注入到工作区 {index}")
+                    else:
+                        logger.error(f"❌ {len(texts)} 条消息注入到工作区 {index} 失败")
+                        if chat_id:
+                            _submit_feishu_reply(
+                                _send_feishu_text,
+                                chat_id,
+                                "❌ 消息注入 Claude Code 窗口失败，请确认窗口未被关闭后重新发送。"
+                            )
+                except Exception as e:
+                    logger.error(f"发送消息到工作区 {index} 失败: {e}")
 
     def ensure_workspace_claude(self, index: int, process_name: str = None) -> Optional[ProcessInputSender]:
         """确保工作区的 Claude Code 进程存在，必要时启动（不等待窗口）"""
         with self._lock:
-            # 如果已有 sender，直接返回
-            if index in self._workspace_senders:
-                sender = self._workspace_senders[index]
-                # 检查窗口是否仍然有效
-                if sender.find_process_and_window():
-                    return sender
-                else:
-                    # 窗口失效，移除旧的 sender
-                    del self._workspace_senders[index]
-                    if index in self._workspace_pids:
-                        del self._workspace_pids[index]
+            self._ensure_send_worker(index)
+            sender = self._workspace_senders.get(index)
+
+        # 如果已有 sender 且窗口仍然有效，直接返回（窗口查找较慢，不在锁内进行）
+        if sender and sender.find_process_and_window():
+            return sender
+
+        with self._lock:
+            current = self._workspace_senders.get(index)
+            if current is not None and current is not sender:
+                # 其他线程已替换为新的 sender
+                return current
+            if current is not None:
+                # 窗口失效，移除旧的 sender
+                del self._workspace_senders[index]
+                self._workspace_pids.pop(index, None)
 
             # 获取工作区配置
             if index >= len(_workspaces):
@@ -290,15 +482,15 @@ class WorkspaceManager:
             logger.info(f"✅ 已启动工作区 {workspace_name} 的 Claude Code，请手动启动窗口或等待其自动启动")
             return sender
 
+    # 以下只读查询直接使用 dict.get / in，GIL 下是原子操作，无需加锁；写操作仍持有 self._lock
+
     def get_pid(self, index: int) -> Optional[int]:
         """获取工作区的 Claude Code 进程 PID"""
-        with self._lock:
-            return self._workspace_pids.get(index)
+        return self._workspace_pids.get(index)
 
     def get_sender_for_workspace(self, index: int) -> Optional[ProcessInputSender]:
         """获取工作区对应的 sender，不自动启动"""
-        with self._lock:
-            return self._workspace_senders.get(index)
+        return self._workspace_senders.get(index)
 
     def get_or_create_sender(self, index: int) -> Optional[ProcessInputSender]:
         """获取或创建工作区的 sender"""
@@ -307,19 +499,26 @@ class WorkspaceManager:
             return sender
         return self.ensure_workspace_claude(index)
 
-    def send_to_workspace(self, index: int, text: str) -> bool:
-        """发送消息到指定工作区"""
+    def send_to_workspace(self, index: int, text: str, chat_id: Optional[str] = None) -> bool:
+        """发送消息到指定工作区（投递到该工作区的注入队列后立即返回），chat_id 为消息来源群聊"""
         sender = self.get_or_create_sender(index)
         if not sender:
             logger.error(f"无法获取工作区 {index} 的 sender")
+            if chat_id:
+                _submit_feishu_reply(_send_feishu_text, chat_id, "❌ 无法连接工作区的 Claude Code，消息未送达，请稍后重试")
             return False
 
-        try:
-            sender.execute(text)
-            return True
-        except Exception as e:
-            logger.error(f"发送消息到工作区 {index} 失败: {e}")
+        with self._lock:
+            dq, ev = self._ensure_send_worker(index)
+        if len(dq) >= self.SEND_QUEUE_MAXSIZE:
+            logger.error(f"工作区 {index} 的注入队列已满，丢弃消息")
+            # 与入口处消息队列满时一致，告知用户消息未被处理
+            if chat_id:
+                _submit_feishu_reply(_send_feishu_text, chat_id, "⏳ 忙碌中，请稍后重试")
             return False
+        dq.append((chat_id, text))
+        ev.set()
+        return True
 
     def close_workspace(self, index: int):
         """关闭指定工作区的 Claude Code（仅从管理器中移除，进程由系统管理）"""
@@ -341,14 +540,12 @@ class WorkspaceManager:
 
     def get_chat_workspace(self, chat_id: str) -> int:
         """获取群聊对应的工作区索引"""
-        with self._lock:
-            # 返回 -1 表示该群聊未绑定工作区
-            return self._workspace_chat_map.get(chat_id, -1)
+        # 返回 -1 表示该群聊未绑定工作区
+        return self._workspace_chat_map.get(chat_id, -1)
 
     def is_chat_bound(self, chat_id: str) -> bool:
         """检查群聊是否已绑定工作区"""
-        with self._lock:
-            return chat_id in self._workspace_chat_map
+        return chat_id in self._workspace_chat_map
 
     def load_persist(self, data: dict):
         """从持久化数据加载"""
@@ -360,7 +557,7 @@ class WorkspaceManager:
         """获取需要持久化的数据"""
         with self._lock:
             return {
-                "workspace_chat_map": self._workspace_chat_map
+                "workspace_chat_map": dict(self._workspace_chat_map)
             }
 
 
@@ -370,14 +567,277 @@ _workspace_manager = WorkspaceManager()
 
 # ==================== GUI 自动化 ====================
 import ctypes
-import win32gui
-import win32con
-import win32api
-import win32clipboard
-import win32process
+from ctypes import wintypes
 import psutil
 
-user32 = ctypes.windll.user32
+# pywin32 / user32 只在 Windows 上加载；其他平台仍可导入本模块（注入功能不可用）
+if sys.platform == "win32":
+    import win32gui
+    import win32con
+    import win32clipboard
+    user32 = ctypes.windll.user32
+    _WNDENUMPROC = ctypes.WINFUNCTYPE(wintypes.BOOL, wintypes.HWND, wintypes.LPARAM)
+else:
+    win32gui = win32con = win32clipboard = None
+    user32 = None
+    _WNDENUMPROC = ctypes.CFUNCTYPE(wintypes.BOOL, wintypes.HWND, wintypes.LPARAM)
+
+# SendInput 所需结构体（一次调用批量提交多个按键事件）
+INPUT_KEYBOARD = 1
+KEYEVENTF_KEYUP = 0x0002
+VK_RETURN = 0x0D
+VK_CONTROL = 0x11
+
+
+class _MOUSEINPUT(ctypes.Structure):
+    _fields_ = [("dx", wintypes.LONG), ("dy", wintypes.LONG), ("mouseData", wintypes.DWORD),
+                ("dwFlags", wintypes.DWORD), ("time", wintypes.DWORD), ("dwExtraInfo", ctypes.c_size_t)]
+
+
+class _KEYBDINPUT(ctypes.Structure):
+    _fields_ = [("wVk", wintypes.WORD), ("wScan", wintypes.WORD), ("dwFlags", wintypes.DWORD),
+                ("time", wintypes.DWORD), ("dwExtraInfo", ctypes.c_size_t)]
+
+
+class _HARDWAREINPUT(ctypes.Structure):
+    _fields_ = [("uMsg", wintypes.DWORD), ("wParamL", wintypes.WORD), ("wParamH", wintypes.WORD)]
+
+
+class _INPUTUNION(ctypes.Union):
+    _fields_ = [("mi", _MOUSEINPUT), ("ki", _KEYBDINPUT), ("hi", _HARDWAREINPUT)]
+
+
+class _INPUT(ctypes.Structure):
+    _fields_ = [("type", wintypes.DWORD), ("union", _INPUTUNION)]
+
+
+GA_ROOT = 2
+SYNCHRONIZE = 0x00100000
+PROCESS_QUERY_LIMITED_INFORMATION = 0x1000
+
+
+class _GUITHREADINFO(ctypes.Structure):
+    _fields_ = [("cbSize", wintypes.DWORD), ("flags", wintypes.DWORD), ("hwndActive", wintypes.HWND),
+                ("hwndFocus", wintypes.HWND), ("hwndCapture", wintypes.HWND), ("hwndMenuOwner", wintypes.HWND),
+                ("hwndMoveSize", wintypes.HWND), ("hwndCaret", wintypes.HWND), ("rcCaret", wintypes.RECT)]
+
+
+# 按键序列 -> 预构建的 INPUT 数组，固定序列只构建一次
+_input_array_cache: Dict[tuple, ctypes.Array] = {}
+
+
+def _send_key_events(events: tuple) -> int:
+    """通过一次 SendInput 调用发送一组按键事件 ((vk, is_keyup), ...)"""
+    arr = _input_array_cache.get(events)
+    if arr is None:
+        arr = (_INPUT * len(events))()
+        for i, (vk, keyup) in enumerate(events):
+            arr[i].type = INPUT_KEYBOARD
+            arr[i].union.ki = _KEYBDINPUT(vk, 0, KEYEVENTF_KEYUP if keyup else 0, 0, 0)
+        _input_array_cache[events] = arr
+    return user32.SendInput(len(events), ctypes.byref(arr), ctypes.sizeof(_INPUT))
+
+
+# Ctrl+V / 回车 按键序列
+_PASTE_KEYS = ((VK_CONTROL, False), (ord('V'), False), (ord('V'), True), (VK_CONTROL, True))
+_ENTER_KEYS = ((VK_RETURN, False), (VK_RETURN, True))
+
+
+TH32CS_SNAPPROCESS = 0x00000002
+_INVALID_HANDLE_VALUE = ctypes.c_void_p(-1).value
+
+
+class _PROCESSENTRY32W(ctypes.Structure):
+    _fields_ = [("dwSize", wintypes.DWORD), ("cntUsage", wintypes.DWORD), ("th32ProcessID", wintypes.DWORD),
+                ("th32DefaultHeapID", ctypes.c_size_t), ("th32ModuleID", wintypes.DWORD),
+                ("cntThreads", wintypes.DWORD), ("th32ParentProcessID", wintypes.DWORD),
+                ("pcPriClassBase", wintypes.LONG), ("dwFlags", wintypes.DWORD),
+                ("szExeFile", wintypes.WCHAR * wintypes.MAX_PATH)]
+
+
+def _toolhelp_processes() -> Optional[List[tuple]]:
+    """CreateToolhelp32Snapshot 一次枚举全部进程，返回 [(pid, ppid, exe_name)]；失败返回 None"""
+    kernel32 = ctypes.windll.kernel32
+    kernel32.CreateToolhelp32Snapshot.restype = wintypes.HANDLE
+    snapshot = kernel32.CreateToolhelp32Snapshot(TH32CS_SNAPPROCESS, 0)
+    if not snapshot or snapshot == _INVALID_HANDLE_VALUE:
+        return None
+    try:
+        entry = _PROCESSENTRY32W(dwSize=ctypes.sizeof(_PROCESSENTRY32W))
+        result = []
+        ok = kernel32.Process32FirstW(wintypes.HANDLE(snapshot), ctypes.byref(entry))
+        while ok:
+            result.append((entry.th32ProcessID, entry.th32ParentProcessID, entry.szExeFile))
+            ok = kernel32.Process32NextW(wintypes.HANDLE(snapshot), ctypes.byref(entry))
+        return result
+    finally:
+        kernel32.CloseHandle(wintypes.HANDLE(snapshot))
+
+
+class _ProcInfo(NamedTuple):
+    pid: int
+    name: str  # 小写进程名
+    ppid: Optional[int]
+    has_claude: bool  # 命令行中是否包含 claude
+
+
+class _ProcSnapshot:
+    """进程列表快照（短 TTL 缓存），避免每次查找窗口都完整遍历系统进程"""
+    TTL = 0.5  # 秒
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._ts: float = 0
+        self._procs: tuple = ()
+        self._by_pid: Dict[int, _ProcInfo] = {}
+
+    def _refresh(self):
+        procs = []
+        # Windows 上用一次 Toolhelp 快照拿到全部 pid/ppid/进程名，不再逐个打开进程
+        entries = _toolhelp_processes() if user32 is not None else None
+        if entries is None:
+            # 不传 attrs：按需调用 name()/ppid() 比预取属性字典更省
+            entries = []
+            for proc in psutil.process_iter():
+                try:
+                    entries.append((proc.pid, proc.ppid(), proc.name() or ''))
+                except (psutil.NoSuchProcess, psutil.AccessDenied):
+                    continue
+
+        for pid, ppid, name in entries:
+            name = name.lower()
+            # 读取 cmdline 开销较大，只对可能运行 claude 命令的进程读取
+            has_claude = False
+            if name in _cli_candidate_names:
+                try:
+                    cmdline = psutil.Process(pid).cmdline() or []
+                    has_claude = _CLAUDE_RE.search(' '.join(cmdline)) is not None
+                except (psutil.NoSuchProcess, psutil.AccessDenied):
+                    pass
+            procs.append(_ProcInfo(pid, name, ppid, has_claude))
+        self._procs = tuple(procs)
+        self._by_pid = {p.pid: p for p in procs}
+        self._ts = time.monotonic()
+
+    def get(self) -> tuple:
+        """获取进程快照，超过 TTL 时刷新"""
+        with self._lock:
+            if time.monotonic() - self._ts > self.TTL:
+                self._refresh()
+            return self._procs
+
+    def invalidate(self):
+        """使快照失效，下次 get() 时强制刷新"""
+        with self._lock:
+            self._ts = 0
+
+    def get_by_pid(self, pid: Optional[int]) -> Optional[_ProcInfo]:
+        """从当前快照中按 PID 查找进程"""
+        if pid is None:
+            return None
+        self.get()
+        return self._by_pid.get(pid)
+
+
+_proc_snapshot = _ProcSnapshot()
+
+
+def _window_pid(hwnd: int) -> int:
+    """返回窗口所属进程的 PID（窗口无效时为 0）"""
+    pid = wintypes.DWORD()
+    user32.GetWindowThreadProcessId(hwnd, ctypes.byref(pid))
+    return pid.value
+
+
+_PID_WINDOW_MAP_TTL = 1.0  # 秒
+_pid_window_map: Dict[int, List[tuple]] = {}
+_pid_window_map_ts: float = 0
+_pid_window_map_lock = threading.Lock()
+
+
+def _get_pid_window_map() -> Dict[int, List[tuple]]:
+    """一次 EnumWindows 构建 {pid: [(hwnd, is_visible)]}，TTL 内复用，多个候选进程共享同一次枚举"""
+    global _pid_window_map, _pid_window_map_ts
+    with _pid_window_map_lock:
+        if time.monotonic() - _pid_window_map_ts <= _PID_WINDOW_MAP_TTL:
+            return _pid_window_map
+
+        pid_map: Dict[int, List[tuple]] = {}
+        found_pid = wintypes.DWORD()
+
+        # 回调次数多，直接用 ctypes 调用 user32，省去 pywin32 的参数封送
+        @_WNDENUMPROC
+        def callback(hwnd, _):
+            user32.GetWindowThreadProcessId(hwnd, ctypes.byref(found_pid))
+            pid_map.setdefault(found_pid.value, []).append((hwnd, bool(user32.IsWindowVisible(hwnd))))
+            return True
+
+        user32.EnumWindows(callback, 0)
+        _pid_window_map = pid_map
+        _pid_window_map_ts = time.monotonic()
+        return pid_map
+
+
+def _invalidate_pid_window_map():
+    """使 PID -> 窗口 映射失效，下次查找时重新枚举"""
+    global _pid_window_map_ts
+    with _pid_window_map_lock:
+        _pid_window_map_ts = 0
+
+
+def _enum_process_windows(pid: int, stop_on_visible: bool = False) -> List[tuple]:
+    """枚举指定进程的顶层窗口，返回 [(hwnd, is_visible)]。
+
+    优先只遍历该进程各线程的窗口（EnumThreadWindows）；控制台窗口由 conhost 创建、
+    不属于这些线程，此时回退到 PID -> 窗口 映射（一次 EnumWindows 构建，短时间内复用）。
+    stop_on_visible=True 时找到第一个可见窗口即停止枚举（回调返回 False）。
+    """
+    windows: List[tuple] = []
+
+    def _add(hwnd) -> bool:
+        visible = win32gui.IsWindowVisible(hwnd)
+        windows.append((hwnd, visible))
+        return not (stop_on_visible and visible)
+
+    def thread_callback(hwnd, _):
+        try:
+            return _add(hwnd)
+        except Exception:
+            return True
+
+    def _hit() -> bool:
+        return stop_on_visible and bool(windows) and windows[-1][1]
+
+    try:
+        for thread in psutil.Process(pid).threads():
+            try:
+                win32gui.EnumThreadWindows(thread.id, thread_callback, None)
+            except Exception:
+                pass  # 回调提前返回 False 时 pywin32 可能抛错，由 _hit() 判断
+            if _hit():
+                return windows
+    except (psutil.NoSuchProcess, psutil.AccessDenied):
+        pass
+    if any(visible for _, visible in windows):
+        return windows
+
+    # 线程窗口全部不可见（输入法/隐藏辅助窗口）或没有时，合并 PID 映射中的窗口（含 conhost 的控制台窗口）
+    seen = {hwnd for hwnd, _ in windows}
+    windows.extend(w for w in _get_pid_window_map().get(pid, ()) if w[0] not in seen)
+    return windows
+
+
+def _best_hwnd_for_pid(pid: int, known_terminal: bool) -> Optional[int]:
+    """返回进程的最佳窗口：可见窗口优先，否则取任意窗口；无窗口返回 None。
+
+    宿主是否为已知终端对同一进程的所有窗口都相同，因此只需区分可见性；
+    已知终端时找到第一个可见窗口即停止枚举。
+    """
+    windows = _enum_process_windows(pid, stop_on_visible=known_terminal)
+    for hwnd, visible in windows:
+        if visible:
+            return hwnd
+    return windows[0][0] if windows else None
 
 
 class ProcessInputSender:
@@ -387,180 +847,193 @@ class ProcessInputSender:
     TERMINAL_PROCESS_NAMES = ("cmd.exe", "powershell.exe", "pwsh.exe", "conhost.exe")
     # Claude 无自己的窗口，只使用这些宿主终端进程的窗口
     HOST_TERMINAL_NAMES = ("cmd.exe", "powershell.exe", "pwsh.exe", "conhost.exe", "windows terminal.exe")
+    # 供热路径 O(1) 判断的小写集合
+    _TERMINAL_SET = frozenset(n.lower() for n in TERMINAL_PROCESS_NAMES)
+    _HOST_SET = frozenset(n.lower() for n in HOST_TERMINAL_NAMES)
+    # OpenClipboard 重试次数与间隔（Windows Terminal 自身粘贴时会短暂占用剪贴板）
+    CLIPBOARD_OPEN_RETRIES = 5
+    CLIPBOARD_OPEN_INTERVAL = 0.05
+    # 会处理 WM_PASTE 的窗口类（标准编辑控件）
+    WM_PASTE_CLASSES = frozenset(("Edit", "RichEdit20W", "RICHEDIT50W")) | frozenset(
+        c.strip() for c in WM_PASTE_EXTRA_CLASSES.split(",") if c.strip())
+    # 缓存窗口的最长复用时间（秒），超时后重新枚举进程，限制 PID 被复用等情况的影响
+    HWND_CACHE_TTL = 5.0
+    # 剪贴板是全局资源，记录最近一次写入的文本及写入后的剪贴板序列号
+    _clipboard_text: Optional[str] = None
+    _clipboard_seq: int = 0
 
     def __init__(self, process_name: str, target_pid: Optional[int] = None):
         self.process_name = (process_name or "claude.exe").strip().lower()
         self.target_pid = target_pid  # 指定要查找的 Claude 进程 PID
+        self._desktop_names = frozenset((self.process_name,)) | _CLAUDE_NAMES_SET
         self.hwnd: Optional[int] = None
         self.pid: Optional[int] = None
+        self._host_pid: Optional[int] = None  # 拥有 hwnd 的宿主进程 PID，用于校验句柄未被复用
+        self._claude_pid: Optional[int] = None  # Claude 本身的进程 PID（self.pid 可能是宿主终端）
+        self._hwnd_cache_ts: float = 0.0  # 最近一次完整查找成功的时间（time.monotonic）
+        self.created_ts: float = time.monotonic()  # 创建时间；带 target_pid 时即 Claude Code 的启动时间
 
     def find_process_and_window(self) -> bool:
         """查找 Claude 进程，并直接使用其父进程（cmd/PowerShell）的窗口"""
+        # 已缓存的窗口和进程仍然有效时跳过进程/窗口枚举
+        if self.hwnd:
+            # 必须确认 Claude 进程本身还在：Claude 退出而终端仍开着时，
+            # 继续往终端粘贴文本 + 回车会被 shell 当作命令执行
+            if (time.monotonic() - self._hwnd_cache_ts < self.HWND_CACHE_TTL
+                    and win32gui.IsWindow(self.hwnd) and _window_pid(self.hwnd) == self._host_pid
+                    and self._claude_pid is not None and psutil.pid_exists(self._claude_pid)):
+                return True
+            logger.debug("缓存的窗口已失效 (hwnd={}, claude_pid={})，重新查找", self.hwnd, self._claude_pid)
+            self.hwnd = None
+            self.pid = None
+            self._claude_pid = None
+
         logger.debug(f"[find_process_and_window] target_pid={self.target_pid}")
 
         # 如果指定了 target_pid，优先用 PID 查找
         if self.target_pid:
             if self._find_by_pid(self.target_pid):
                 logger.debug(f"[find_process_and_window] 通过 target_pid={self.target_pid} 找到窗口")
+                self._hwnd_cache_ts = time.monotonic()
                 return True
             logger.debug(f"[find_process_and_window] target_pid={self.target_pid} 查找失败，回退到其他方法")
 
+        # 一次遍历进程快照，同时分出 CLI 候选和桌面版候选
+        cli_procs, desktop_procs = self._scan_once()
+
         # 优先尝试查找 CLI 版本（终端中运行的 claude 命令）
-        if self._find_cli_process():
+        if self._find_cli_process(cli_procs):
             logger.debug(f"[find_process_and_window] 通过 _find_cli_process 找到窗口")
+            self._hwnd_cache_ts = time.monotonic()
             return True
 
         # 其次尝试查找桌面版
-        result = self._find_desktop_process()
+        result = self._find_desktop_process(desktop_procs)
         logger.debug(f"[find_process_and_window] _find_desktop_process 结果: {result}")
+        if result:
+            self._hwnd_cache_ts = time.monotonic()
+        else:
+            # 查找失败时丢弃进程缓存，下次重试重新枚举，避免使用过期条目
+            _proc_snapshot.invalidate()
+            _invalidate_pid_window_map()
+            getattr(psutil.process_iter, 'cache_clear', lambda: None)()
         return result
 
     def _find_by_pid(self, target_pid: int) -> bool:
         """通过指定的 PID 查找 Claude 进程和窗口"""
-        try:
-            # 获取 Claude 进程
-            proc = psutil.Process(target_pid)
-            proc_name = proc.name().lower()
-
-            # 如果是终端进程，直接找窗口
-            if proc_name in [n.lower() for n in ProcessInputSender.TERMINAL_PROCESS_NAMES]:
-                logger.debug(f"目标 PID 是终端进程: {proc_name}")
-                return self._find_terminal_window(target_pid, proc_name)
-
-            # 如果是 claude.exe，找其父进程窗口
-            if 'claude' in proc_name:
-                parent = proc.parent()
-                if parent:
-                    parent_name = parent.name().lower()
-                    logger.debug(f"Claude 进程的终端: {parent_name}")
-                    return self._find_terminal_window(parent.pid, parent_name)
-
-            logger.debug(f"PID {target_pid} 进程名: {proc_name}")
-        except (psutil.NoSuchProcess, psutil.AccessDenied) as e:
-            logger.debug(f"查找 PID {target_pid} 失败: {e}")
+        # 进程名和父 PID 直接取自进程快照，避免构造 Process 对象及 parent() 的额外系统调用
+        info = _proc_snapshot.get_by_pid(target_pid)
+        if not info:
+            logger.debug(f"查找 PID {target_pid} 失败: 进程不存在")
+            return False
+        proc_name = info.name
+
+        # 如果是终端进程，直接找窗口
+        if proc_name in ProcessInputSender._TERMINAL_SET:
+            logger.debug(f"目标 PID 是终端进程: {proc_name}")
+            # 缓存校验需要 Claude 本身的 PID：在终端的子进程中查找 Claude（claude.exe 或命令行含 claude 的 node 等）
+            claude_pid = next((p.pid for p in _proc_snapshot.get()
+                               if p.ppid == target_pid and (p.name in _CLAUDE_NAMES_SET or p.has_claude)), None)
+            if claude_pid is None:
+                logger.debug(f"终端 PID {target_pid} 中未运行 Claude，跳过")
+                return False
+            if self._find_terminal_window(target_pid, proc_name):
+                self._claude_pid = claude_pid
+                return True
+            return False
 
+        # 如果是 claude.exe，找其父进程窗口
+        if 'claude' in proc_name and info.ppid:
+            parent = _proc_snapshot.get_by_pid(info.ppid)
+            if parent:
+                parent_name = parent.name
+            else:
+                # 父进程不在快照中（刚启动），才单独查询
+                try:
+                    parent_name = psutil.Process(info.ppid).name().lower()
+                except (psutil.NoSuchProcess, psutil.AccessDenied) as e:
+                    logger.debug(f"查找 PID {target_pid} 的父进程失败: {e}")
+                    return False
+            logger.debug(f"Claude 进程的终端: {parent_name}")
+            if self._find_terminal_window(info.ppid, parent_name):
+                self._claude_pid = target_pid
+                return True
+            return False
+
+        logger.debug(f"PID {target_pid} 进程名: {proc_name}")
         return False
 
     def _find_terminal_window(self, terminal_pid: int, terminal_name: str = "") -> bool:
-        """查找终端进程的窗口"""
+        """查找终端进程的窗口（优先只枚举该进程线程的窗口）"""
         host_pid = terminal_pid
-        host_candidates: List[tuple] = []
-
-        def host_callback(hwnd, _):
-            try:
-                _, found_pid = win32process.GetWindowThreadProcessId(hwnd)
-                if found_pid != host_pid:
-                    return True
-                visible = win32gui.IsWindowVisible(hwnd)
-                known = terminal_name in ProcessInputSender.TERMINAL_PROCESS_NAMES
-                host_candidates.append((hwnd, visible, known))
-            except Exception:
-                pass
-            return True
-
-        win32gui.EnumWindows(host_callback, None)
-        # 优先：已知终端且可见 > 已知终端 > 可见 > 任意
-        host_candidates.sort(key=lambda x: (not x[2], not x[1], 0))
-        if host_candidates:
-            self.hwnd = host_candidates[0][0]
+        hwnd = _best_hwnd_for_pid(host_pid, terminal_name in ProcessInputSender._TERMINAL_SET)
+        if hwnd:
+            self.hwnd = hwnd
             self.pid = host_pid
+            self._host_pid = _window_pid(self.hwnd)
             logger.debug("使用终端窗口 hwnd={} ({})", self.hwnd, terminal_name)
             return True
 
         return False
 
-    def _find_cli_process(self) -> bool:
+    def _scan_once(self) -> tuple:
+        """单次遍历进程快照，返回 (CLI 候选, 桌面版候选)；桌面版候选中与 process_name 精确匹配的排在前面"""
+        desktop_names = self._desktop_names
+        cli_procs: List[_ProcInfo] = []
+        preferred: List[_ProcInfo] = []
+        fallback: List[_ProcInfo] = []
+        for info in _proc_snapshot.get():
+            name = info.name
+            if name in desktop_names:
+                (preferred if name == self.process_name else fallback).append(info)
+            # 命令行包含 claude（但不是 claude.exe 进程）：在终端中运行的 CLI
+            elif info.has_claude and name not in _CLAUDE_NAMES_SET:
+                cli_procs.append(info)
+        return cli_procs, preferred or fallback
+
+    def _find_cli_process(self, cli_procs: List[_ProcInfo]) -> bool:
         """查找 CLI 版本 - 终端中运行的 claude 命令"""
         logger.debug("尝试查找 Claude CLI 进程...")
 
-        for proc in psutil.process_iter(['pid', 'name', 'cmdline']):
-            try:
-                info = proc.info
-                cmdline = info.get('cmdline') or []
-                cmdline_str = ' '.join(cmdline).lower() if cmdline else ''
-
-                # 检查命令行是否包含 claude（但不是 claude.exe 进程）
-                name_lower = info.get('name', '').lower()
-                if 'claude' in cmdline_str and not name_lower.startswith('claude'):
-                    # 找到在终端中运行的 claude
-                    pid = info['pid']
-                    parent = psutil.Process(pid).parent()
-                    if not parent:
-                        continue
+        for info in cli_procs:
+            parent = _proc_snapshot.get_by_pid(info.ppid)
+            if not parent:
+                continue
 
-                    parent_name = parent.name().lower()
-                    logger.debug("找到 CLI 进程: pid={}, 终端={}", pid, parent_name)
+            parent_name = parent.name
+            logger.debug("找到 CLI 进程: pid={}, 终端={}", info.pid, parent_name)
 
-                    # 查找终端窗口
-                    if self._find_terminal_window(parent.pid, parent_name):
-                        logger.info("找到 Claude CLI 窗口 (终端: {})", parent_name)
-                        return True
-            except (psutil.NoSuchProcess, psutil.AccessDenied):
-                continue
+            # 查找终端窗口
+            if self._find_terminal_window(parent.pid, parent_name):
+                self._claude_pid = info.pid
+                logger.info("找到 Claude CLI 窗口 (终端: {})", parent_name)
+                return True
 
         return False
 
-    def _find_desktop_process(self) -> bool:
+    def _find_desktop_process(self, desktop_procs: List[_ProcInfo]) -> bool:
         """查找桌面版 - claude.exe 进程"""
         logger.debug("尝试查找 Claude 桌面版进程...")
 
-        names_to_try = [self.process_name]
-        if self.process_name not in ProcessInputSender.DEFAULT_PROCESS_NAMES:
-            names_to_try.extend(("claude.exe", "claude"))
-
-        target_pids: List[int] = []
-        seen: set = set()
-        for name_key in names_to_try:
-            for proc in psutil.process_iter(['name', 'pid']):
-                try:
-                    pname = (proc.info.get('name') or '').lower()
-                    pid = proc.info.get('pid')
-                    if pid in seen:
-                        continue
-                    if name_key in pname or pname in name_key:
-                        target_pids.append(pid)
-                        seen.add(pid)
-                except (psutil.NoSuchProcess, psutil.AccessDenied):
-                    continue
-            if target_pids:
-                break
-
-        if not target_pids:
-            logger.debug("未找到 Claude 相关进程 (尝试名: {})", names_to_try)
+        if not desktop_procs:
+            logger.debug("未找到 Claude 相关进程 (进程名: {})", self.process_name)
             return False
 
         # 遍历每个 Claude 进程，取第一个能找到「父进程窗口」的（cmd/PowerShell/或任意宿主如 Cursor）
-        for claude_pid in target_pids:
-            self.pid = claude_pid
-            try:
-                parent = psutil.Process(claude_pid).parent()
-                if not parent:
-                    continue
-                parent_name = (parent.name() or "").lower()
-                host_pid = parent.pid
-                host_candidates: List[tuple] = []  # (hwnd, is_visible, is_known_terminal)
-
-                def host_callback(hwnd, _):
-                    try:
-                        _, found_pid = win32process.GetWindowThreadProcessId(hwnd)
-                        if found_pid != host_pid:
-                            return True
-                        visible = win32gui.IsWindowVisible(hwnd)
-                        known = parent_name in ProcessInputSender.HOST_TERMINAL_NAMES
-                        host_candidates.append((hwnd, visible, known))
-                    except Exception:
-                        pass
-                    return True
-
-                win32gui.EnumWindows(host_callback, None)
-                # 优先：已知终端且可见 > 已知终端 > 可见 > 任意
-                host_candidates.sort(key=lambda x: (not x[2], not x[1], 0))
-                if host_candidates:
-                    self.hwnd = host_candidates[0][0]
-                    logger.debug("使用宿主窗口 hwnd={} ({} pid={})", self.hwnd, parent_name, host_pid)
-                    return True
-            except (psutil.NoSuchProcess, psutil.AccessDenied, AttributeError):
+        for info in desktop_procs:
+            self.pid = info.pid
+            parent = _proc_snapshot.get_by_pid(info.ppid)
+            if not parent:
                 continue
+            parent_name = parent.name
+            host_pid = parent.pid
+            hwnd = _best_hwnd_for_pid(host_pid, parent_name in ProcessInputSender._HOST_SET)
+            if hwnd:
+                self.hwnd = hwnd
+                self._host_pid = _window_pid(self.hwnd)
+                self._claude_pid = info.pid
+                logger.debug("使用宿主窗口 hwnd={} ({} pid={})", self.hwnd, parent_name, host_pid)
+                return True
 
         logger.debug("找到 Claude 进程但父进程无可用窗口")
         return False
@@ -570,6 +1043,16 @@ class ProcessInputSender:
         if not self.hwnd:
             return
 
+        # 确保目标是顶层窗口（而不是可能失去焦点的子控件）
+        root = user32.GetAncestor(self.hwnd, GA_ROOT)
+        if root and root != self.hwnd:
+            logger.debug("目标窗口 {} 不是顶层窗口，改用其根窗口 {}", self.hwnd, root)
+            self.hwnd = root
+
+        # 已是前台窗口时无需任何激活操作
+        if win32gui.GetForegroundWindow() == self.hwnd:
+            return
+
         # 简化处理：直接尝试激活一次，失败则跳过
         try:
             if win32gui.IsIconic(self.hwnd):
@@ -578,63 +1061,108 @@ class ProcessInputSender:
         except Exception:
             pass
 
-        time.sleep(0.2)
-
-    def send_text_via_clipboard(self, text: str):
-        """通过剪贴板粘贴发送（支持中文）。若剪贴板被占用会重试若干次。"""
-        if not self.hwnd:
-            return
-
-        # 先激活窗口并等待
-        self.activate_window()
-        time.sleep(0.3)
+        # 等待窗口真正成为前台窗口（最多 0.5 秒），取代固定延迟
+        t0 = time.monotonic()
+        while win32gui.GetForegroundWindow() != self.hwnd and time.monotonic() - t0 < 0.5:
+            time.sleep(0.005)
+
+        # 校验键盘焦点确实落在目标窗口内（GetFocus 只对本线程有效，需通过 GetGUIThreadInfo 获取）
+        info = _GUITHREADINFO(cbSize=ctypes.sizeof(_GUITHREADINFO))
+        if user32.GetGUIThreadInfo(0, ctypes.byref(info)):
+            focus = info.hwndFocus
+            if focus and focus != self.hwnd and not user32.IsChild(self.hwnd, focus):
+                logger.warning("键盘焦点不在目标窗口内 (hwnd={}, focus={})，注入可能失败", self.hwnd, focus)
+
+    def _set_clipboard_text(self, text: str) -> bool:
+        """写入剪贴板。若剪贴板被占用会重试若干次。"""
+        # 剪贴板内容仍是上次写入的同一文本（序列号未变），无需重新写入和广播
+        cls = ProcessInputSender
+        if text == cls._clipboard_text and win32clipboard.GetClipboardSequenceNumber() == cls._clipboard_seq:
+            return True
 
-        # 剪贴板可能被其他进程占用（OpenClipboard 报错 5 拒绝访问），重试几次
+        # 剪贴板可能被其他进程占用（OpenClipboard 报错 5 拒绝访问），只对打开操作短间隔重试
         last_err = None
-        for attempt in range(5):
+        for _ in range(self.CLIPBOARD_OPEN_RETRIES):
             try:
                 win32clipboard.OpenClipboard()
-                try:
-                    win32clipboard.EmptyClipboard()
-                    win32clipboard.SetClipboardText(text, win32clipboard.CF_UNICODETEXT)
-                finally:
-                    win32clipboard.CloseClipboard()
-                last_err = None
                 break
             except Exception as e:
                 last_err = e
-                try:
-                    win32clipboard.CloseClipboard()
-                except Exception:
-                    pass
-                if attempt < 4:
-                    time.sleep(0.15 * (attempt + 1))
-        if last_err is not None:
-            logger.warning("剪贴板写入失败（已重试 5 次）: {}，跳过本次注入", last_err)
-            return
+                time.sleep(self.CLIPBOARD_OPEN_INTERVAL)
+        else:
+            logger.warning("剪贴板被占用（已重试 {} 次）: {}，跳过本次注入", self.CLIPBOARD_OPEN_RETRIES, last_err)
+            return False
+
+        try:
+            win32clipboard.EmptyClipboard()
+            win32clipboard.SetClipboardText(text, win32clipboard.CF_UNICODETEXT)
+        except Exception as e:
+            logger.warning("剪贴板写入失败: {}，跳过本次注入", e)
+            return False
+        finally:
+            win32clipboard.CloseClipboard()
+        cls._clipboard_text = text
+        cls._clipboard_seq = win32clipboard.GetClipboardSequenceNumber()
+        return True
+
+    def send_text_via_clipboard(self, text: str, submit: bool = False) -> bool:
+        """通过剪贴板粘贴发送（支持中文）。submit=True 时在同一批按键中追加回车。"""
+        if not self.hwnd:
+            return False
+
+        if not self._set_clipboard_text(text):
+            return False
+
+        # 支持 WM_PASTE 的窗口直接发消息粘贴，无需抢占前台
+        if self._try_wm_paste(submit):
+            return True
 
-        time.sleep(0.3)
-
-        # 模拟 Ctrl+V - 增加延迟确保窗口准备好
-        win32api.keybd_event(win32con.VK_CONTROL, 0, 0, 0)
-        time.sleep(0.05)
-        win32api.keybd_event(ord('V'), 0, 0, 0)
-        time.sleep(0.05)
-        win32api.keybd_event(ord('V'), 0, win32con.KEYEVENTF_KEYUP, 0)
-        time.sleep(0.05)
-        win32api.keybd_event(win32con.VK_CONTROL, 0, win32con.KEYEVENTF_KEYUP, 0)
-        time.sleep(0.3)
-
-    def press_enter(self):
-        """发送回车键"""
-        win32api.keybd_event(win32con.VK_RETURN, 0, 0, 0)
-        time.sleep(0.1)
-        win32api.keybd_event(win32con.VK_RETURN, 0, win32con.KEYEVENTF_KEYUP, 0)
-
-    def execute(self, command: str):
         self.activate_window()
-        self.send_text_via_clipboard(command)
-        self.press_enter()
+
+        # Ctrl+V（及回车）通过一次 SendInput 批量提交
+        keys = _PASTE_KEYS + _ENTER_KEYS if submit else _PASTE_KEYS
+        if _send_key_events(keys) != len(keys):
+            # 注入失败，下次重新查找窗口
+            logger.warning("SendInput 注入失败 (hwnd={})，将重新查找窗口", self.hwnd)
+            self.hwnd = None
+            return False
+        return True
+
+    def _try_wm_paste(self, submit: bool) -> bool:
+        """向 self.hwnd 发送 WM_PASTE。仅对处理该消息的编辑类窗口有效（控制台/Windows Terminal 会忽略）"""
+        hwnd = self.hwnd
+        try:
+            cls = win32gui.GetClassName(hwnd)
+        except Exception:
+            return False
+        if cls not in ProcessInputSender.WM_PASTE_CLASSES:
+            return False
+
+        try:
+            rc, _ = win32gui.SendMessageTimeout(hwnd, win32con.WM_PASTE, 0, 0, win32con.SMTO_ABORTIFHUNG, 200)
+        except Exception as e:
+            logger.debug("WM_PASTE 发送失败 (hwnd={}): {}", hwnd, e)
+            return False
+        if not rc:
+            return False
+        if submit:
+            win32gui.PostMessage(hwnd, win32con.WM_KEYDOWN, win32con.VK_RETURN, 0)
+            win32gui.PostMessage(hwnd, win32con.WM_KEYUP, win32con.VK_RETURN, 0)
+        return True
+
+    def execute(self, command: str) -> bool:
+        """粘贴文本并回车提交，返回是否注入成功"""
+        return self.send_text_via_clipboard(command, submit=True)
+
+
+_terminal_names_set = ProcessInputSender._TERMINAL_SET
+# Claude 自身的进程名（桌面版/原生 CLI）
+_CLAUDE_NAMES_SET = frozenset(ProcessInputSender.DEFAULT_PROCESS_NAMES)
+# 命令行中的 claude 关键字（如 .../claude-code/cli.js、claude.cmd）
+_CLAUDE_RE = re.compile(r'\bclaude\b', re.I)
+# 可能在命令行中运行 claude 的进程：终端/shell 进程，以及 npm 安装版 CLI 所用的 node；
+# 只有这些进程才读取 cmdline（读取需打开进程并访问 PEB，开销最大）
+_cli_candidate_names = _terminal_names_set | {"node.exe", "node", "bash.exe", "wsl.exe"}
 
 
 # ==================== Claude Code 启动器 ====================
@@ -656,14 +1184,13 @@ def launch_claude_code(workspace: dict = None) -> Optional[int]:
 
     logger.info(f"正在启动 Claude Code (工作目录: {workspace_name}): {CLAUDE_PATH}")
 
-    os.chdir(work_dir)
-
     # 添加 --dangerously-skip-permissions 跳过 "Do you want to proceed?" 确认
     cmd = [CLAUDE_PATH, "--dangerously-skip-permissions"]
 
     try:
         proc = subprocess.Popen(
             cmd,
+            cwd=work_dir,
             creationflags=subprocess.CREATE_NEW_CONSOLE
         )
         pid = proc.pid
@@ -674,16 +1201,38 @@ def launch_claude_code(workspace: dict = None) -> Optional[int]:
         return None
 
 
-def wait_for_claude_window(sender: ProcessInputSender, timeout: int = 30) -> bool:
+def _wait_for_input_idle(pid: int, timeout: float) -> bool:
+    """WaitForInputIdle 等待进程就绪。控制台进程没有消息队列，会立即失败返回 False"""
+    kernel32 = ctypes.windll.kernel32
+    handle = kernel32.OpenProcess(SYNCHRONIZE | PROCESS_QUERY_LIMITED_INFORMATION, False, pid)
+    if not handle:
+        return False
+    try:
+        return user32.WaitForInputIdle(handle, int(timeout * 1000)) == 0
+    finally:
+        kernel32.CloseHandle(handle)
+
+
+def wait_for_claude_window(sender: ProcessInputSender, timeout: float = 30) -> bool:
     """等待 Claude Code 窗口出现"""
     logger.info(f"等待 Claude Code 窗口出现 (超时 {timeout}秒)...")
-    start_time = time.time()
+    deadline = time.monotonic() + timeout
+
+    # 已知启动的 PID 时先阻塞等待其进入输入空闲状态（GUI 进程创建好窗口后返回）
+    if sender.target_pid:
+        _wait_for_input_idle(sender.target_pid, timeout)
+        if sender.find_process_and_window():
+            logger.info("✅ Claude Code 窗口已就绪")
+            return True
 
-    while time.time() - start_time < timeout:
+    # 自适应退避：窗口通常在启动后 1~2 秒内出现，先密后疏地轮询
+    delay = 0.05
+    while time.monotonic() < deadline:
         if sender.find_process_and_window():
             logger.info("✅ Claude Code 窗口已就绪")
             return True
-        time.sleep(1)
+        time.sleep(delay)
+        delay = min(delay * 2, 1.0)
 
     logger.warning("⚠️ 等待窗口超时，请手动启动 Claude Code")
     return False
@@ -708,27 +1257,13 @@ class ExtendedWSClient(lark_oapi.ws.Client):
     
     async def _handle_data_frame(self, frame):
         """重写数据帧处理，添加卡片回调支持"""
-        import http
-        import base64
-        from lark_oapi.ws.enum import MessageType
-        from lark_oapi.ws.const import HEADER_MESSAGE_ID, HEADER_TRACE_ID, HEADER_SUM, HEADER_SEQ, HEADER_TYPE, HEADER_BIZ_RT
-        from lark_oapi.ws.model import Response
-        from lark_oapi.core.const import UTF_8
-        from lark_oapi.core.json import JSON
-        import time
-        
-        def _get_by_key(headers, key: str) -> str:
-            for header in headers:
-                if header.key == key:
-                    return header.value
-            raise Exception(f"Header not found: {key}")
-        
         hs = frame.headers
-        msg_id = _get_by_key(hs, HEADER_MESSAGE_ID)
-        trace_id = _get_by_key(hs, HEADER_TRACE_ID)
-        sum_ = _get_by_key(hs, HEADER_SUM)
-        seq = _get_by_key(hs, HEADER_SEQ)
-        type_ = _get_by_key(hs, HEADER_TYPE)
+        hdrs = {h.key: h.value for h in hs}
+        msg_id = hdrs[HEADER_MESSAGE_ID]
+        trace_id = hdrs[HEADER_TRACE_ID]
+        sum_ = hdrs[HEADER_SUM]
+        seq = hdrs[HEADER_SEQ]
+        type_ = hdrs[HEADER_TYPE]
         
         pl = frame.payload
         if int(sum_) > 1:
@@ -772,31 +1307,26 @@ class ExtendedWSClient(lark_oapi.ws.Client):
 
 
 # ==================== 飞书机器人 ====================
-_feishu_client = None
-
-
+@functools.lru_cache(maxsize=1)
 def _get_feishu_client():
-    global _feishu_client
-    if _feishu_client is None:
-        _feishu_client = (
-            lark_oapi.Client.builder()
-            .app_id(APP_ID)
-            .app_secret(APP_SECRET)
-            .build()
-        )
-    return _feishu_client
+    """飞书 API 客户端（首次调用时构建并缓存）"""
+    return (
+        lark_oapi.Client.builder()
+        .app_id(APP_ID)
+        .app_secret(APP_SECRET)
+        .build()
+    )
 
 
 def _send_feishu_text(chat_id: str, text: str) -> bool:
     if not chat_id or not text:
         return False
     try:
-        from lark_oapi.api.im.v1 import CreateMessageRequest, CreateMessageRequestBody
         body = (
             CreateMessageRequestBody.builder()
             .receive_id(chat_id)
             .msg_type("text")
-            .content(lark_oapi.JSON.marshal({"text": text}))
+            .content(_json_dumps({"text": text}))
             .build()
         )
         req = CreateMessageRequest.builder().receive_id_type("chat_id").request_body(body).build()
@@ -807,54 +1337,112 @@ def _send_feishu_text(chat_id: str, text: str) -> bool:
         return False
 
 
-def _send_workspace_selection_card(chat_id: str, open_id: str = None):
-    """发送工作目录选择卡片"""
-    if not _workspaces:
-        _send_feishu_text(chat_id, "⚠️ 未配置任何工作目录，请检查 WORK_DIRS 环境变量")
-        return
+# 飞书回复在独立线程中发送，事件回调和注入流程不等待网络往返；FIFO 保证同一聊天的回复顺序
+_reply_queue = queue.SimpleQueue()
+_reply_thread: Optional[threading.Thread] = None
+_reply_thread_lock = threading.Lock()
+
+
+def _reply_worker():
+    """飞书回复 worker：依次执行投递的发送任务"""
+    while True:
+        func, args = _reply_queue.get()
+        try:
+            func(*args)
+        except Exception as e:
+            logger.warning("飞书回复任务失败: {}", e)
+
+
+def _submit_feishu_reply(func, *args):
+    """投递飞书回复任务（可在任意线程调用），首次调用时启动发送线程"""
+    global _reply_thread
+    if _reply_thread is None:
+        with _reply_thread_lock:
+            if _reply_thread is None:
+                _reply_thread = threading.Thread(target=_reply_worker, name="feishu-reply", daemon=True)
+                _reply_thread.start()
+    _reply_queue.put((func, args))
+
+
+# 工作目录选择卡片模板（固定部分在模块加载时构建一次）
+_WS_CARD_TEMPLATE = {
+    "config": {"wide_screen_mode": True},
+    "header": {
+        "title": {"tag": "plain_text", "content": "📂 选择工作目录"},
+        "template": "blue"
+    },
+    "elements": [
+        {
+            "tag": "markdown",
+            "content": None
+        },
+        {
+            "tag": "div",
+            "text": {"tag": "plain_text", "content": "点击下方按钮切换工作目录，切换后将自动启动对应目录的 Claude Code"}
+        },
+        {
+            "tag": "action",
+            "actions": None
+        }
+    ]
+}
+
+
+# 已序列化的卡片 JSON 缓存：(工作区列表, 当前索引, JSON)；列表对象或当前索引变化时重建
+_ws_card_cache: Optional[tuple] = None
+
+
+def _invalidate_workspace_card():
+    global _ws_card_cache
+    _ws_card_cache = None
+
+
+def _get_workspace_card_json() -> str:
+    """获取工作目录选择卡片的 JSON（工作区和当前目录未变时复用缓存）"""
+    global _ws_card_cache
+    cache = _ws_card_cache
+    if cache is not None and cache[0] is _workspaces and cache[1] == _current_workspace_index:
+        return cache[2]
 
     # 构建按钮列表
     actions = []
-    for i, ws in enumerate(_workspaces):
+    for i, name in enumerate(_workspace_names):
         # 每个按钮的 value 包含索引和目录名
         actions.append({
             "tag": "button",
-            "text": {"tag": "plain_text", "content": f"📁 {ws['name']}"},
+            "text": {"tag": "plain_text", "content": f"📁 {name}"},
             "type": "primary" if i == _current_workspace_index else "default",
             "action_id": f"ws_select_{i}",
-            "value": {"index": str(i), "name": ws['name']}
+            "value": {"index": str(i), "name": name}
         })
 
-    # 构建卡片内容
+    # 构建卡片内容（固定部分复用模板，只生成变化的 markdown 和按钮）
     card_content = {
-        "config": {"wide_screen_mode": True},
-        "header": {
-            "title": {"tag": "plain_text", "content": "📂 选择工作目录"},
-            "template": "blue"
-        },
+        "config": _WS_CARD_TEMPLATE["config"],
+        "header": _WS_CARD_TEMPLATE["header"],
         "elements": [
-            {
-                "tag": "markdown",
-                "content": get_workspace_display_text()
-            },
-            {
-                "tag": "div",
-                "text": {"tag": "plain_text", "content": "点击下方按钮切换工作目录，切换后将自动启动对应目录的 Claude Code"}
-            },
-            {
-                "tag": "action",
-                "actions": actions
-            }
+            {"tag": "markdown", "content": get_workspace_display_text()},
+            _WS_CARD_TEMPLATE["elements"][1],
+            {"tag": "action", "actions": actions},
         ]
     }
+    card_json = _json_dumps(card_content)
+    _ws_card_cache = (_workspaces, _current_workspace_index, card_json)
+    return card_json
+
+
+def _send_workspace_selection_card(chat_id: str, open_id: str = None):
+    """发送工作目录选择卡片"""
+    if not _workspaces:
+        _send_feishu_text(chat_id, "⚠️ 未配置任何工作目录，请检查 WORK_DIRS 环境变量")
+        return
 
     try:
-        from lark_oapi.api.im.v1 import CreateMessageRequest, CreateMessageRequestBody
         body = (
             CreateMessageRequestBody.builder()
             .receive_id(chat_id)
             .msg_type("interactive")
-            .content(lark_oapi.JSON.marshal(card_content))
+            .content(_get_workspace_card_json())
             .build()
         )
         req = CreateMessageRequest.builder().receive_id_type("chat_id").request_body(body).build()
@@ -869,9 +1457,12 @@ def _parse_message_content(content) -> str:
     if content is None:
         return ""
     if isinstance(content, str):
+        # 非 JSON 对象或不含 text 字段时无需解析，避免普通文本走异常分支
+        stripped = content.lstrip()
+        if stripped[:1] != '{' or '"text"' not in stripped:
+            return content
         try:
-            obj = json.loads(content)
-            return obj.get("text", content)
+            return _json_loads(stripped).get("text", content)
         except Exception:
             return content
     if isinstance(content, dict):
@@ -879,47 +1470,56 @@ def _parse_message_content(content) -> str:
     return str(content)
 
 
-def _extract_event_fields(data):
-    if hasattr(data, "event"):
-        event = data.event
-    elif isinstance(data, dict):
-        event = data.get("event")
-    else:
-        return None, None, None
-    if not event:
-        return None, None, None
-
-    if hasattr(event, "message"):
-        message = event.message
-        sender = getattr(event, "sender", None)
-    elif isinstance(event, dict):
-        message = event.get("message")
-        sender = event.get("sender")
-    else:
-        return None, None, None
-    if not message:
-        return None, None, None
-
-    open_id = None
-    if sender:
-        if hasattr(sender, "sender_id"):
-            sid = sender.sender_id
-            open_id = getattr(sid, "open_id", None) if sid else None
-        elif isinstance(sender, dict):
-            sid = sender.get("sender_id") or {}
-            open_id = sid.get("open_id") if isinstance(sid, dict) else getattr(sid, "open_id", None)
-
-    content = message.get("content") if isinstance(message, dict) else getattr(message, "content", None)
-    user_text = _parse_message_content(content).strip() if content else ""
-    chat_id = message.get("chat_id") if isinstance(message, dict) else getattr(message, "chat_id", None)
+class _EventView:
+    """事件数据的统一访问视图：逐级取值时自动兼容字典和 SDK 对象"""
+    __slots__ = ("_data",)
 
-    return user_text, open_id, chat_id
+    def __init__(self, data):
+        self._data = data
 
+    def g(self, *path, default=None):
+        cur = self._data
+        if type(cur) is dict:
+            # HTTP 回调为纯字典：直接下标取值，遇到非字典层级再走通用路径
+            try:
+                for key in path:
+                    cur = cur[key]
+                return default if cur is None else cur
+            except KeyError:
+                return default
+            except TypeError:
+                cur = self._data
+        for key in path:
+            if cur is None:
+                return default
+            cur = cur.get(key) if isinstance(cur, dict) else getattr(cur, key, None)
+        return default if cur is None else cur
+
+
+def _extract_open_id(data) -> Optional[str]:
+    """只提取发送者 open_id（不解析消息内容），用于尽早过滤非管理员消息"""
+    return _EventView(data).g("event", "sender", "sender_id", "open_id")
+
+
+def _extract_message_fields(data):
+    """提取 (user_text, chat_id)，消息体不存在时返回 None"""
+    message = _EventView(data).g("event", "message")
+    if not message:
+        return None
 
+    msg = _EventView(message)
+    content = msg.g("content")
+    user_text = _parse_message_content(content).strip() if content else ""
+    return user_text, msg.g("chat_id")
 
 
 # ==================== 消息处理 ====================
-_message_queue = queue.Queue()
+# 待处理消息：append/popleft 在 GIL 下是原子操作，配合 Event 唤醒单个消费者，无需加锁
+_message_deque: deque = deque()
+_message_event = threading.Event()
+_MESSAGE_QUEUE_MAXSIZE = 64
+# 队列容量信号量：投递前获取，worker 处理完后释放
+_message_slots = threading.Semaphore(_MESSAGE_QUEUE_MAXSIZE)
 
 
 def _check_config():
@@ -932,54 +1532,26 @@ def _check_config():
         sys.exit(1)
 
 
+def _extract_action_open_id(data) -> Optional[str]:
+    """只提取卡片交互操作者的 open_id，用于尽早过滤非管理员交互"""
+    ev = _EventView(data)
+    return ev.g("event", "operator", "open_id") or ev.g("event", "operator", "user_id")
+
+
 def _extract_action_callback_fields(data):
-    """提取卡片交互回调的字段 - 支持 SDK 对象和字典两种格式"""
+    """提取卡片交互回调的字段 - 支持 SDK 对象 (P2CardActionTrigger) 和字典两种格式"""
+    ev = _EventView(data)
+
     action = None
-    open_id = None
-    chat_id = None
-
-    logger.info("_extract_action_callback_fields 收到数据: {}", type(data))
-
-    # 方式1: SDK 对象 (P2CardActionTrigger)
-    if hasattr(data, "event"):
-        event = data.event
-        logger.info("使用 SDK 对象方式解析, event 类型: {}", type(event))
-
-        if hasattr(event, "action") and event.action:
-            action_obj = event.action
-            # action.value 是一个字典，如 {"action": "switch_workspace", ...}
-            action_value = getattr(action_obj, "value", None)
-            if isinstance(action_value, dict):
-                action = action_value.get("action") or action_value.get("value")
-            if not action:
-                action = getattr(action_obj, "name", "") or getattr(action_obj, "value", "")
-
-        if hasattr(event, "operator") and event.operator:
-            operator = event.operator
-            open_id = getattr(operator, "open_id", None) or getattr(operator, "user_id", None)
-            logger.info("operator open_id: {}", open_id)
-
-        if hasattr(event, "context") and event.context:
-            context = event.context
-            chat_id = getattr(context, "open_chat_id", None)
-            logger.info("context open_chat_id: {}", chat_id)
-
-    # 方式2: 字典格式
-    elif isinstance(data, dict):
-        logger.info("使用字典方式解析")
-        event = data.get("event", {})
-        action_obj = event.get("action", {})
-        action_value = action_obj.get("value", {})
-        if isinstance(action_value, dict):
-            action = action_value.get("action") or action_value.get("value")
-        if not action:
-            action = action_obj.get("name", "") or action_obj.get("value", "")
-
-        operator = event.get("operator", {})
-        open_id = operator.get("open_id") or operator.get("user_id")
-
-        context = event.get("context", {})
-        chat_id = context.get("open_chat_id")
+    # action.value 是一个字典，如 {"action": "switch_workspace", ...}
+    action_value = ev.g("event", "action", "value")
+    if isinstance(action_value, dict):
+        action = action_value.get("action") or action_value.get("value")
+    if not action:
+        action = ev.g("event", "action", "name", default="") or action_value or ""
+
+    open_id = ev.g("event", "operator", "open_id") or ev.g("event", "operator", "user_id")
+    chat_id = ev.g("event", "context", "open_chat_id")
 
     # 处理 action 值 - 支持多种格式
     if isinstance(action, dict):
@@ -987,7 +1559,7 @@ def _extract_action_callback_fields(data):
         action = action.get("name") or action.get("action") or action.get("value") or str(action)
     action_text = str(action) if action else "未知操作"
 
-    logger.info("解析结果: action={}, open_id={}, chat_id={}", action_text, open_id, chat_id)
+    logger.debug("卡片回调解析 ({}): action={}, open_id={}, chat_id={}", type(data).__name__, action_text, open_id, chat_id)
     return action_text, open_id, chat_id
 
 
@@ -997,9 +1569,8 @@ def do_action_callback(data):
     logger.info("收到卡片回调事件 - 开始处理")
 
     try:
-        interaction_text, open_id, chat_id = _extract_action_callback_fields(data)
-        logger.info("解析结果 - action: {}, open_id: {}, chat_id: {}", interaction_text, open_id, chat_id)
-
+        # 先只取 operator open_id 做权限过滤，非管理员交互不解析 action
+        open_id = _extract_action_open_id(data)
         if not open_id:
             logger.info("无法解析卡片交互的 open_id，跳过")
             return
@@ -1008,41 +1579,42 @@ def do_action_callback(data):
             logger.info(f"非管理员卡片交互已忽略: {open_id}")
             return
 
+        interaction_text, open_id, chat_id = _extract_action_callback_fields(data)
+
         logger.info(f"收到飞书卡片交互: {interaction_text} (open_id: {open_id}, chat_id: {chat_id})")
 
         # 直接处理工作区切换（不投递到消息队列）
         workspace_name = interaction_text.strip()
-        workspaces = load_workspace_configs()
-        idx = None
-        for i, ws in enumerate(workspaces):
-            if ws["name"] == workspace_name:
-                idx = i
-                break
+        load_workspace_configs()
+        idx = _workspace_name_index.get(workspace_name)
 
         if idx is not None:
             if switch_workspace(idx, chat_id):
                 ws = get_current_workspace()
-                _send_feishu_text(chat_id, f"✅ 已切换到工作目录: **{ws['name']}**\n路径: {ws['path']}")
+                _submit_feishu_reply(_send_feishu_text, chat_id, f"✅ 已切换到工作目录: **{ws['name']}**\n路径: {ws['path']}")
                 # 启动新工作目录的 Claude Code
                 _workspace_manager.ensure_workspace_claude(idx)
                 logger.info("工作区切换成功: {}", ws["name"])
             else:
-                _send_feishu_text(chat_id, f"❌ 切换工作区失败")
+                _submit_feishu_reply(_send_feishu_text, chat_id, f"❌ 切换工作区失败")
         else:
-            _send_feishu_text(chat_id, f"❌ 未找到工作区: {workspace_name}")
+            _submit_feishu_reply(_send_feishu_text, chat_id, f"❌ 未找到工作区: {workspace_name}")
 
         logger.info("=" * 50)
 
     except Exception as e:
-        logger.error("处理卡片回调异常: {}", e)
-        import traceback
-        logger.error("详细堆栈: {}", traceback.format_exc())
+        logger.exception("处理卡片回调异常: {}", e)
+
+
+# 触发工作目录选择卡片的命令
+_WS_CMDS = frozenset(("/切换", "/目录", "/workspace", "/ws"))
 
 
 def do_process(data):
     """处理飞书消息"""
     try:
-        user_text, open_id, chat_id = _extract_event_fields(data)
+        # 先只取 open_id 做权限过滤，非管理员消息不解析内容
+        open_id = _extract_open_id(data)
         if not open_id:
             logger.info("无法解析 open_id，跳过")
             return
@@ -1051,32 +1623,29 @@ def do_process(data):
             logger.info(f"非管理员消息已忽略: {open_id}")
             return
 
-        # 解析消息内容
-        msg_type = "text"
-        if hasattr(data, "event") and hasattr(data.event, "message"):
-            message = data.event.message
-            msg_type = getattr(message, "msg_type", "text")
-        elif isinstance(data, dict):
-            event = data.get("event", {})
-            message = event.get("message", {})
-            msg_type = message.get("msg_type", "text")
-
+        # 非文本消息只需 chat_id 回复提示，不解析消息内容
+        ev = _EventView(data)
+        msg_type = ev.g("event", "message", "msg_type", default="text")
         if msg_type != "text":
+            chat_id = ev.g("event", "message", "chat_id")
             if chat_id:
-                _send_feishu_text(chat_id, f"⚠️ 暂不支持 {msg_type} 格式")
+                _submit_feishu_reply(_send_feishu_text, chat_id, f"⚠️ 暂不支持 {msg_type} 格式")
             return
 
+        # 解析消息内容
+        user_text, chat_id = _extract_message_fields(data) or (None, None)
+
         if not user_text:
             logger.info("空文本消息，跳过")
             return
 
         logger.info(f"收到飞书消息: {user_text[:50]}... (open_id: {open_id}, chat_id: {chat_id})")
 
-        # 处理工作目录切换命令
-        user_text_lower = user_text.strip().lower()
-        if user_text_lower in ["/切换", "/目录", "/workspace", "/ws"]:
+        # 处理工作目录切换命令（user_text 已在解析时 strip）
+        user_text_lower = user_text.lower()
+        if user_text_lower in _WS_CMDS:
             # 发送工作目录选择卡片
-            _send_workspace_selection_card(chat_id, open_id)
+            _submit_feishu_reply(_send_workspace_selection_card, chat_id, open_id)
             return
 
         # 处理数字选择切换目录（从卡片点击传来的数字）
@@ -1084,132 +1653,266 @@ def do_process(data):
             idx = int(user_text_lower) - 1
             if switch_workspace(idx, chat_id):
                 ws = get_current_workspace()
-                _send_feishu_text(chat_id, f"✅ 已切换到工作目录: **{ws['name']}**\n路径: {ws['path']}")
+                _submit_feishu_reply(_send_feishu_text, chat_id, f"✅ 已切换到工作目录: **{ws['name']}**\n路径: {ws['path']}")
                 # 启动新工作目录的 Claude Code（使用工作区管理器）
                 _workspace_manager.ensure_workspace_claude(idx)
             return
 
+        # 队列已满时直接提示忙碌，避免突发消息无限堆积
+        if not _message_slots.acquire(blocking=False):
+            logger.warning("消息队列已满，拒绝消息 (chat_id: {})", chat_id)
+            if chat_id:
+                _submit_feishu_reply(_send_feishu_text, chat_id, "⏳ 忙碌中，请稍后重试")
+            return
+
         # 直接投递到队列 (包含 open_id 用于后续回复)，不再额外发状态提醒到飞书
-        _message_queue.put((user_text, open_id, chat_id))
+        _message_deque.append((user_text, open_id, chat_id))
+        _message_event.set()
 
     except Exception as e:
-        logger.error("处理消息异常: {}", e)
+        logger.exception("处理消息异常: {}", e)
 
 
+# 卡片交互消息的正文前缀
+_CARD_PREFIX = "【卡片交互】"
 
+# 注入到 Claude Code 的飞书标记模板
+# 卡片交互消息
+_CARD_MARKER_TMPL = """【系统提示】此消息来自飞书（卡片交互回调）。
+- 当前工作区: {ws}
+- 用户已点击卡片按钮，请根据用户的操作继续处理
+- 请使用飞书机器人 MCP 工具将结果传回给用户
 
-def _message_worker():
-    """消息处理 worker - 支持多工作区路由"""
+交互内容：
+{body}"""
+# 普通文本消息
+_TEXT_MARKER_TMPL = """【系统提示】此消息来自飞书。
+- 当前工作区: {ws}
+- 请使用飞书机器人 MCP 工具将结果传回给用户
+
+用户消息：
+{body}"""
+# (是否卡片消息, 工作区名) -> 已渲染的标记前缀；模板均以 {body} 结尾，注入时只需拼接正文
+_marker_prefix_cache: Dict[tuple, str] = {}
+
+
+def _build_feishu_marker(workspace_name: str, user_text: str) -> str:
+    """构造带飞书标记的注入文本"""
+    key = (user_text.startswith(_CARD_PREFIX), workspace_name)
+    prefix = _marker_prefix_cache.get(key)
+    if prefix is None:
+        tmpl = _CARD_MARKER_TMPL if key[0] else _TEXT_MARKER_TMPL
+        prefix = _marker_prefix_cache[key] = tmpl.format(ws=workspace_name, body="")
+    return prefix + user_text
+
+_MESSAGE_BATCH_MAX = 16  # 每次唤醒最多批量取出的消息数
+# 规范化后的工作区目录 -> 最近写入的 chat_id（不用 workspace_index：自动发现重新扫描后索引可能变化）
+_last_chat_id_by_workspace: Dict[str, str] = {}
+
+# 文件写入在独立线程中执行，消息 worker 只负责投递
+_file_write_queue = queue.SimpleQueue()
+_file_write_thread: Optional[threading.Thread] = None
+_file_write_thread_lock = threading.Lock()
+
+
+def _file_write_worker():
+    """文件写入 worker：依次执行投递的写入任务"""
     while True:
+        func, args = _file_write_queue.get()
         try:
-            item = _message_queue.get()
-            # 支持新版格式: (user_text, open_id, chat_id) 和旧版格式: (user_text, chat_id)
-            if isinstance(item, tuple) and len(item) >= 3:
-                user_text, open_id, chat_id = item[0], item[1], item[2]
-            else:
-                user_text, chat_id = item if isinstance(item, tuple) else (item, None)
-                open_id = None
+            func(*args)
+        except Exception as e:
+            logger.warning("文件写入任务失败: {}", e)
 
-            # 确定使用哪个工作区
-            logger.info("消息路由调试 - chat_id: {}, _workspace_chat_map: {}",
-                       chat_id, _workspace_manager._workspace_chat_map)
-            if chat_id:
-                workspace_index = _workspace_manager.get_chat_workspace(chat_id)
-                logger.info("根据 chat_id 获取的工作区索引: {}", workspace_index)
-                # 新群聊未绑定工作区时，提示用户选择
-                if workspace_index == -1:
-                    _send_feishu_text(chat_id, "👋 您好！这是您首次在此群聊中使用 Claude Code，请先选择一个工作区：")
-                    _send_workspace_selection_card(chat_id, open_id)
-                    _message_queue.task_done()
-                    continue
-            else:
-                workspace_index = _current_workspace_index
-                logger.info("无 chat_id，使用全局工作区索引: {}", workspace_index)
 
-            # 获取工作区信息
-            if workspace_index < len(_workspaces):
-                workspace_name = _workspaces[workspace_index].get("name", f"工作区{workspace_index}")
-            else:
-                workspace_name = "默认"
-
-            logger.info(f"正在注入消息到 {workspace_name} (索引: {workspace_index})...")
-
-            # 获取该工作区的 sender
-            sender = _workspace_manager.get_or_create_sender(workspace_index)
-            if not sender:
-                logger.error(f"无法获取工作区 {workspace_name} 的 Claude Code 窗口")
-                if chat_id:
-                    _send_feishu_text(
-                        chat_id,
-                        f"❌ 无法连接到工作区 {workspace_name} 的 Claude Code，请确保已启动。"
-                    )
-                _message_queue.task_done()
-                continue
+def _submit_file_write(func, *args):
+    """投递文件写入任务，首次调用时启动写入线程"""
+    global _file_write_thread
+    if _file_write_thread is None:
+        with _file_write_thread_lock:
+            if _file_write_thread is None:
+                _file_write_thread = threading.Thread(target=_file_write_worker, name="file-writer", daemon=True)
+                _file_write_thread.start()
+    _file_write_queue.put((func, args))
 
-            # 刷新窗口句柄
-            if not sender.find_process_and_window():
-                logger.error(f"未找到工作区 {workspace_name} 的 Claude Code 窗口")
-                if chat_id:
-                    _send_feishu_text(
-                        chat_id,
-                        f"❌ 未找到工作区 {workspace_name} 的 Claude Code 窗口，请先启动或还原。"
-                    )
-                _message_queue.task_done()
-                continue
 
-            # 将当前 chat_id 写入工作区目录的配置文件，供 MCP 工具自动读取
-            workspace_dir = _workspaces[workspace_index].get("path", "")
-            if workspace_dir and chat_id:
-                # 写入 .feishu_current_chat_id 文件
-                chat_id_file = os.path.join(workspace_dir, ".feishu_current_chat_id")
-                try:
-                    with open(chat_id_file, 'w', encoding='utf-8') as f:
-                        f.write(chat_id)
-                    logger.debug(f"已更新工作区 chat_id 文件: {chat_id_file}")
-                except Exception as e:
-                    logger.warning(f"写入 chat_id 文件失败: {e}")
+def _workspace_key(workspace_dir: str) -> str:
+    """工作区目录的规范化键（大小写/相对路径不同仍视为同一目录）"""
+    return os.path.normcase(os.path.abspath(workspace_dir))
 
-                # 同时更新 .env 文件中的 FEISHU_CURRENT_CHAT_ID
-                update_workspace_env_chat_id(workspace_dir, chat_id)
 
-            # 检测并提示 admin open_id
-            if open_id:
-                detect_and_prompt_admin_open_id(open_id)
+def _write_workspace_chat_id(workspace_dir: str, chat_id: str):
+    """写入工作区的 .feishu_current_chat_id 文件，并同步更新 .env 中的 FEISHU_CURRENT_CHAT_ID"""
+    chat_id_file = os.path.join(workspace_dir, ".feishu_current_chat_id")
+    try:
+        # 先写临时文件再原子替换，MCP 端读取时不会读到写了一半的内容
+        tmp_file = chat_id_file + ".tmp"
+        with open(tmp_file, 'w', encoding='utf-8') as f:
+            f.write(chat_id)
+        os.replace(tmp_file, chat_id_file)
+        logger.debug(f"已更新工作区 chat_id 文件: {chat_id_file}")
+    except Exception as e:
+        # 写入失败时清除缓存，下一条消息会重试
+        _last_chat_id_by_workspace.pop(_workspace_key(workspace_dir), None)
+        logger.warning(f"写入 chat_id 文件失败: {e}")
 
-            # 构造带飞书标记的消息，提示 Claude 使用 feishu-bot MCP 回复
-            is_card_interaction = user_text.startswith("【卡片交互】")
+    update_workspace_env_chat_id(workspace_dir, chat_id)
 
-            if is_card_interaction:
-                # 卡片交互消息
-                feishu_marker = f"""【系统提示】此消息来自飞书（卡片交互回调）。
-- 当前工作区: {workspace_name}
-- 用户已点击卡片按钮，请根据用户的操作继续处理
-- 请使用飞书机器人 MCP 工具将结果传回给用户
 
-交互内容：
-{user_text}"""
-            else:
-                # 普通文本消息
-                feishu_marker = f"""【系统提示】此消息来自飞书。
-- 当前工作区: {workspace_name}
-- 请使用飞书机器人 MCP 工具将结果传回给用户
+def _normalize_queue_item(item):
+    """支持新版格式: (user_text, open_id, chat_id) 和旧版格式: (user_text, chat_id)"""
+    if isinstance(item, tuple) and len(item) >= 3:
+        return item[0], item[1], item[2]
+    user_text, chat_id = item if isinstance(item, tuple) else (item, None)
+    return user_text, None, chat_id
 
-用户消息：
-{user_text}"""
 
-            # 执行注入
-            sender.execute(feishu_marker)
-            logger.info(f"✅ 消息已注入到 {workspace_name}")
+_WINDOW_RETRY_DELAYS = (0.25, 0.5, 1.0)  # 查找窗口失败后的重试间隔（秒）
+_LAUNCH_WINDOW_TIMEOUT = 15.0  # 新启动的 Claude Code 等待窗口出现的最长时间（秒）
 
-            # 定期保存持久化（每10条消息）
-            if _message_queue.qsize() % 10 == 0:
-                _save_workspace_persist()
 
-            _message_queue.task_done()
+def _wait_sender_window(sender: ProcessInputSender) -> bool:
+    """查找 sender 的窗口，失败时按 _WINDOW_RETRY_DELAYS 退避重试；刚启动的进程等待其窗口出现"""
+    if sender.find_process_and_window():
+        return True
+    # 刚由 ensure_workspace_claude 启动的进程窗口可能尚未创建，等待其就绪而不是立即报错
+    remaining = _LAUNCH_WINDOW_TIMEOUT - (time.monotonic() - sender.created_ts)
+    if sender.target_pid and remaining > 0:
+        return wait_for_claude_window(sender, remaining)
+    for delay in _WINDOW_RETRY_DELAYS:
+        time.sleep(delay)
+        if sender.find_process_and_window():
+            return True
+    return False
+
+
+def _process_chat_batch(chat_id, items: list) -> int:
+    """处理同一 chat_id 的一批消息：工作区路由、窗口查找、chat_id 写入每批只做一次
+
+    Returns:
+        投递到注入队列的消息数
+    """
+    open_id = next((oid for _, oid in items if oid), None)
+
+    # 确定使用哪个工作区
+    logger.opt(lazy=True).debug("消息路由调试 - chat_id: {}, _workspace_chat_map: {}",
+                                lambda: chat_id, lambda: dict(_workspace_manager._workspace_chat_map))
+    if chat_id:
+        workspace_index = _workspace_manager.get_chat_workspace(chat_id)
+        logger.debug("根据 chat_id 获取的工作区索引: {}", workspace_index)
+        # 新群聊未绑定工作区时，提示用户选择
+        if workspace_index == -1:
+            _submit_feishu_reply(_send_feishu_text, chat_id, "👋 您好！这是您首次在此群聊中使用 Claude Code，请先选择一个工作区：")
+            _submit_feishu_reply(_send_workspace_selection_card, chat_id, open_id)
+            return 0
+    else:
+        workspace_index = _current_workspace_index
+        logger.debug("无 chat_id，使用全局工作区索引: {}", workspace_index)
+
+    # 获取工作区信息（只索引一次，后续复用局部变量）
+    if 0 <= workspace_index < len(_workspaces):
+        ws = _workspaces[workspace_index]
+        workspace_name = ws.get("name", f"工作区{workspace_index}")
+        workspace_dir = ws.get("path", "")
+    else:
+        workspace_name = "默认"
+        workspace_dir = ""
+
+    logger.info(f"正在注入 {len(items)} 条消息到 {workspace_name} (索引: {workspace_index})...")
+
+    # 获取该工作区的 sender
+    sender = _workspace_manager.get_or_create_sender(workspace_index)
+    if not sender:
+        logger.error(f"无法获取工作区 {workspace_name} 的 Claude Code 窗口")
+        if chat_id:
+            _submit_feishu_reply(
+                _send_feishu_text,
+                chat_id,
+                f"❌ 无法连接到工作区 {workspace_name} 的 Claude Code，请确保已启动。"
+            )
+        return 0
+
+    # 刷新窗口句柄（窗口短暂不可用时有限次退避重试，避免直接丢弃消息）
+    if not _wait_sender_window(sender):
+        logger.error(f"未找到工作区 {workspace_name} 的 Claude Code 窗口")
+        if chat_id:
+            _submit_feishu_reply(
+                _send_feishu_text,
+                chat_id,
+                f"❌ 未找到工作区 {workspace_name} 的 Claude Code 窗口，请先启动或还原。"
+            )
+        return 0
+
+    # 将当前 chat_id 写入工作区目录的配置文件，供 MCP 工具自动读取（与上次相同则跳过）
+    if workspace_dir and chat_id:
+        workspace_key = _workspace_key(workspace_dir)
+        if _last_chat_id_by_workspace.get(workspace_key) != chat_id:
+            _last_chat_id_by_workspace[workspace_key] = chat_id
+            _submit_file_write(_write_workspace_chat_id, workspace_dir, chat_id)
+
+    # 检测并提示 admin open_id
+    if open_id:
+        detect_and_prompt_admin_open_id(open_id)
+
+    sent = 0
+    # 连续的同类消息（卡片/文本）共用一个飞书标记头，正文以分隔线拼接后一次投递
+    for _, run in groupby((text for text, _ in items), key=lambda t: t.startswith(_CARD_PREFIX)):
+        texts = list(run)
+        # 构造带飞书标记的消息，提示 Claude 使用 feishu-bot MCP 回复
+        feishu_marker = _build_feishu_marker(workspace_name, WorkspaceManager.INJECT_SEPARATOR.join(texts))
+
+        # 投递到工作区注入队列，由后台 worker 执行注入
+        if _workspace_manager.send_to_workspace(workspace_index, feishu_marker, chat_id):
+            logger.info(f"{len(texts)} 条消息已投递到 {workspace_name} 的注入队列")
+            sent += len(texts)
+    return sent
+
+
+def _message_worker():
+    """消息处理 worker - 支持多工作区路由，每次唤醒批量取出消息并按 chat_id 分组处理"""
+    processed = 0
+    # 循环内频繁使用的全局函数绑定为局部变量，减少全局/属性查找
+    dq = _message_deque
+    popleft = dq.popleft
+    wait = _message_event.wait
+    clear = _message_event.clear
+    normalize = _normalize_queue_item
+    batch_max = _MESSAGE_BATCH_MAX
+    while True:
+        try:
+            # 队列为空时才等待；clear 之后到达的消息会再次 set，不会丢失唤醒
+            if not dq:
+                wait()
+            clear()
+            batch = []
+            while dq and len(batch) < batch_max:
+                batch.append(popleft())
+            if not batch:
+                continue
+
+            # 按 chat_id 分组（保持首次出现顺序，组内消息顺序不变）
+            groups: Dict[Optional[str], list] = {}
+            for item in batch:
+                user_text, open_id, chat_id = normalize(item)
+                groups.setdefault(chat_id, []).append((user_text, open_id))
+
+            for chat_id, items in groups.items():
+                try:
+                    sent = _process_chat_batch(chat_id, items)
+                except Exception as e:
+                    logger.error("消息处理异常: {}", e)
+                    continue
+                finally:
+                    for _ in items:
+                        _message_slots.release()
+
+                # 定期保存持久化（每10条消息）
+                if (processed + sent) // 10 > processed // 10:
+                    _save_workspace_persist()
+                processed += sent
 
         except Exception as e:
             logger.error("消息处理异常: {}", e)
-            _message_queue.task_done()
 
 
 # ==================== 主程序 ====================
@@ -1271,7 +1974,7 @@ if __name__ == "__main__":
 
     def _cleanup():
         """程序退出时保存持久化"""
-        _save_workspace_persist()
+        _persist_writer.flush_sync()
         logger.info("已保存工作区持久化数据")
 
     atexit.register(_cleanup)
@@ -1279,7 +1982,7 @@ if __name__ == "__main__":
     # 捕获 Ctrl+C 信号
     def signal_handler(signum, frame):
         logger.info("收到退出信号，正在保存数据...")
-        _save_workspace_persist()
+        _persist_writer.flush_sync()
         sys.exit(0)
 
     signal.signal(signal.SIGINT, signal_handler)
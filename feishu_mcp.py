@@ -13,9 +13,12 @@ MCP 工具：让 Claude Code 拥有「发飞书消息」的能力。
 import asyncio
 import json
 import os
+import random
+import re
 import sys
 import time
 import tempfile
+from contextlib import asynccontextmanager
 from typing import Optional, Dict, Any
 
 try:
@@ -38,12 +41,23 @@ import httpx
 from fastmcp import FastMCP
 from loguru import logger
 
+try:
+    import aiofiles
+except ImportError:
+    aiofiles = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 # 配置 loguru
 logger.remove()
 logger.add(
     sys.stderr,
     format="<green>{time:HH:mm:ss}</green> | <level>{level:<7}</level> | <level>{message}</level>",
     level="INFO",
+    enqueue=True,  # 由后台线程写 stderr，日志输出不阻塞事件循环
 )
 
 # ==================== 配置 ====================
@@ -56,7 +70,7 @@ logger.info(f"FEISHU_APP_SECRET loaded: {bool(APP_SECRET)}, value: {APP_SECRET[:
 
 # 白名单配置（可选，填写后只允许发送给这些用户）
 ALLOWED_OPEN_IDS = os.environ.get("FEISHU_ALLOWED_OPEN_IDS", "").strip()
-ALLOWED_OPEN_IDS_LIST = [oid.strip() for oid in ALLOWED_OPEN_IDS.split(",") if oid.strip()] if ALLOWED_OPEN_IDS else []
+ALLOWED_OPEN_IDS_SET = frozenset(oid.strip() for oid in ALLOWED_OPEN_IDS.split(",") if oid.strip()) if ALLOWED_OPEN_IDS else frozenset()
 
 # 自动发送结果开关（读取类工具是否自动发送结果给用户）
 AUTO_SEND_RESULT = os.environ.get("FEISHU_AUTO_SEND_RESULT", "true").strip().lower() == "true"
@@ -68,7 +82,66 @@ LONG_CONTENT_THRESHOLD = int(os.environ.get("FEISHU_LONG_CONTENT_THRESHOLD", "10
 if not APP_ID or not APP_SECRET:
     logger.warning("未配置 FEISHU_APP_ID 或 FEISHU_APP_SECRET，发送飞书消息将失败")
 
-mcp = FastMCP("Feishu-Bot")
+@asynccontextmanager
+async def _lifespan(server):
+    """MCP 服务生命周期：退出时关闭共享的 HTTP 连接池"""
+    try:
+        yield
+    finally:
+        if _feishu_client is not None:
+            await _feishu_client.aclose()
+
+
+mcp = FastMCP("Feishu-Bot", lifespan=_lifespan)
+
+
+# ==================== JSON 序列化 ====================
+# 安装了 orjson 时优先使用（更快），否则回退到标准库 json
+def _json_dumps(obj) -> str:
+    """序列化为紧凑 JSON 字符串（保留非 ASCII 字符）"""
+    if orjson is not None:
+        return orjson.dumps(obj).decode('utf-8')
+    return json.dumps(obj, ensure_ascii=False, separators=(',', ':'))
+
+
+# 解析 JSON 字符串或字节串（直接绑定实现，热路径上不再判断 orjson 是否可用）
+_json_loads = orjson.loads if orjson is not None else json.loads
+
+
+async def _read_file_bytes(path: str) -> bytes:
+    """异步读取整个文件，避免大文件读盘阻塞事件循环（未安装 aiofiles 时放到线程池读取）"""
+    if aiofiles is not None:
+        async with aiofiles.open(path, "rb") as f:
+            return await f.read()
+
+    def _read() -> bytes:
+        with open(path, "rb") as f:
+            return f.read()
+    return await asyncio.to_thread(_read)
+
+
+# ==================== 消息模板 ====================
+# 卡片/富文本中固定不变的片段在导入时构建一次，各次调用共享（只读，仅用于序列化，不可修改）
+_CARD_CONFIG = {"wide_screen_mode": True}
+_EMPTY_POST_CONTENT = [[{"tag": "text", "text": ""}]]
+
+# 飞书卡片标题栏支持的颜色模板
+_VALID_TEMPLATES = frozenset({
+    "default", "blue", "wathet", "turquoise", "green", "yellow", "orange",
+    "red", "carmine", "violet", "purple", "indigo", "grey",
+})
+
+
+def _build_markdown_card(title: str, content: str, template: str = "blue") -> Dict:
+    """构建「标题 + markdown 正文」的卡片，只为可变字段分配新对象"""
+    return {
+        "config": _CARD_CONFIG,
+        "header": {
+            "title": {"tag": "plain_text", "content": title},
+            "template": template,
+        },
+        "elements": [{"tag": "markdown", "content": content}],
+    }
 
 
 # ==================== Token 缓存 ====================
@@ -78,6 +151,10 @@ class TokenCache:
     def __init__(self):
         self._token: Optional[str] = None
         self._expire_time: float = 0
+        # 刷新锁：并发请求缓存失效时只有一个协程去获取新 token；
+        # asyncio.Lock 绑定事件循环，与 FeishuClient._get_client 一致，循环变化时重新创建
+        self._lock: Optional[asyncio.Lock] = None
+        self._lock_loop: Optional[asyncio.AbstractEventLoop] = None
 
     def is_valid(self) -> bool:
         """检查缓存的 token 是否有效"""
@@ -94,14 +171,27 @@ class TokenCache:
         self._token = token
         self._expire_time = time.time() + expire_seconds - 300
 
+    def get_lock(self) -> asyncio.Lock:
+        """获取绑定当前事件循环的刷新锁（需在协程中调用）"""
+        loop = asyncio.get_running_loop()
+        if self._lock is None or self._lock_loop is not loop:
+            self._lock = asyncio.Lock()
+            self._lock_loop = loop
+        return self._lock
+
+    def invalidate(self, stale_token: Optional[str] = None):
+        """清除缓存；指定 stale_token 时仅当缓存仍是该 token 才清除（避免清掉其他协程刚刷新的 token）"""
+        if stale_token is None or self._token == stale_token:
+            self._token = None
+
 
 # ==================== 白名单验证 ====================
 def validate_open_id(open_id: str) -> bool:
     """验证 open_id 是否在白名单中"""
-    if not ALLOWED_OPEN_IDS_LIST:
+    if not ALLOWED_OPEN_IDS_SET:
         # 未配置白名单，放行所有
         return True
-    return open_id in ALLOWED_OPEN_IDS_LIST
+    return open_id in ALLOWED_OPEN_IDS_SET
 
 
 def get_default_open_id() -> str:
@@ -114,6 +204,10 @@ def get_default_chat_id() -> str:
     return os.getenv("FEISHU_DEFAULT_CHAT_ID", "")
 
 
+# 匹配 .env 中的 FEISHU_CURRENT_CHAT_ID 行，group(1) 为值
+_ENV_CHAT_ID_RE = re.compile(r'^[ \t]*FEISHU_CURRENT_CHAT_ID[ \t]*=[ \t]*(.*?)[ \t]*\r?$', re.M)
+
+
 def get_current_chat_id() -> str:
     """获取当前工作区的 chat_id（自动传递机制）
 
@@ -139,12 +233,9 @@ def get_current_chat_id() -> str:
     if os.path.exists(env_file):
         try:
             with open(env_file, 'r', encoding='utf-8') as f:
-                for line in f:
-                    line = line.strip()
-                    if line and not line.startswith('#') and '=' in line:
-                        k, v = line.split('=', 1)
-                        if k.strip() == "FEISHU_CURRENT_CHAT_ID":
-                            return v.strip()
+                m = _ENV_CHAT_ID_RE.search(f.read())
+                if m:
+                    return m.group(1)
         except Exception as e:
             logger.warning(f"读取 .env 中的 CHAT_ID 失败: {e}")
 
@@ -200,7 +291,11 @@ async def auto_send_result(open_id: str, tool_name: str, result: Dict) -> None:
         return
 
     if not open_id or not validate_open_id(open_id):
-        logger.debug(f"跳过自动发送: open_id={open_id}, 白名单验证={validate_open_id(open_id) if open_id else 'N/A'}")
+        # lazy：INFO 级别下不做格式化，也不重复执行白名单校验
+        logger.opt(lazy=True).debug(
+            "跳过自动发送: open_id={}, 白名单验证={}",
+            lambda: open_id, lambda: validate_open_id(open_id) if open_id else 'N/A',
+        )
         return
 
     client = get_feishu_client()
@@ -351,19 +446,7 @@ async def _send_as_file_fallback(open_id: str, tool_name: str, md_content: str)
     # 去掉第一行标题
     content_clean = "\n".join(md_content.split("\n")[1:]) if md_content.startswith("#") else md_content
 
-    file_card = {
-        "config": {"wide_screen_mode": True},
-        "header": {
-            "title": {"tag": "plain_text", "content": f"📄 {tool_name} 详细内容"},
-            "template": "blue"
-        },
-        "elements": [
-            {
-                "tag": "markdown",
-                "content": content_clean[:6000]
-            }
-        ]
-    }
+    file_card = _build_markdown_card(f"📄 {tool_name} 详细内容", content_clean[:6000])
 
     if len(md_content) > 6000:
         await client.send_message(open_id, "interactive", file_card)
@@ -458,9 +541,84 @@ class FeishuClient:
 
     BASE_URL = "https://open.feishu.cn/open-apis"
 
+    # 重试策略：指数退避 + 随机抖动，避免大量客户端同步重试
+    RETRY_ATTEMPTS = 3
+    RETRY_BASE = 0.25
+    RETRY_CAP = 8.0
+    RETRY_JITTER = 0.25
+    RETRYABLE_STATUS = frozenset({429, 502, 503, 504})
+
     def __init__(self, app_id: str, app_secret: str):
         self.app_id = app_id
         self.app_secret = app_secret
+        # 共享的 HTTP 客户端（连接池复用 TCP/TLS 连接），绑定创建它的事件循环
+        self._client: Optional[httpx.AsyncClient] = None
+        self._client_loop: Optional[asyncio.AbstractEventLoop] = None
+
+    async def _get_client(self) -> httpx.AsyncClient:
+        """获取共享的 httpx.AsyncClient，首次使用或事件循环变化时创建"""
+        loop = asyncio.get_running_loop()
+        if self._client is None or self._client.is_closed or self._client_loop is not loop:
+            if self._client is not None and not self._client.is_closed:
+                # 事件循环已变化：关闭旧客户端释放其连接池（旧循环可能已关闭，失败时忽略）
+                try:
+                    await self._client.aclose()
+                except Exception as e:
+                    logger.debug("关闭旧 HTTP 客户端失败: {}", e)
+            self._client = httpx.AsyncClient(
+                timeout=10.0,
+                limits=httpx.Limits(max_keepalive_connections=20, keepalive_expiry=30),
+            )
+            self._client_loop = loop
+        return self._client
+
+    async def aclose(self):
+        """关闭共享的 HTTP 客户端"""
+        if self._client is not None and not self._client.is_closed:
+            await self._client.aclose()
+        self._client = None
+
+    def _retry_delay(self, attempt: int, resp: Optional[httpx.Response] = None) -> Optional[float]:
+        """计算第 attempt 次失败后的等待秒数；服务端要求的 Retry-After 超过上限时返回 None（放弃重试）"""
+        if resp is not None:
+            retry_after = resp.headers.get("Retry-After")
+            if retry_after:
+                try:
+                    seconds = float(retry_after)
+                except ValueError:
+                    seconds = None
+                if seconds is not None:
+                    return seconds if seconds <= self.RETRY_CAP else None
+        return min(self.RETRY_BASE * 2 ** attempt, self.RETRY_CAP) + random.uniform(0, self.RETRY_JITTER)
+
+    async def _post_with_retry(self, url: str, **kwargs) -> httpx.Response:
+        """
+        POST 请求，对网络异常和 429/5xx 做指数退避重试
+
+        其他状态码直接返回响应，由调用方解析业务错误码；重试耗尽时返回最后一次响应或抛出最后一次异常。
+        """
+        for attempt in range(self.RETRY_ATTEMPTS):
+            last = attempt == self.RETRY_ATTEMPTS - 1
+            try:
+                client = await self._get_client()
+                resp = await client.post(url, **kwargs)
+            except httpx.TransportError as e:
+                if last:
+                    raise
+                delay = self._retry_delay(attempt)
+                logger.warning("请求异常 (尝试 {}): {}，{:.2f}s 后重试", attempt + 1, e, delay)
+                await asyncio.sleep(delay)
+                continue
+
+            if resp.status_code not in self.RETRYABLE_STATUS or last:
+                return resp
+            delay = self._retry_delay(attempt, resp)
+            if delay is None:
+                return resp
+            logger.warning("请求被限流/服务不可用 (HTTP {}, 尝试 {})，{:.2f}s 后重试",
+                           resp.status_code, attempt + 1, delay)
+            await asyncio.sleep(delay)
+        return resp
 
     async def get_token(self) -> Optional[str]:
         """获取 tenant_access_token（带缓存）"""
@@ -469,9 +627,14 @@ class FeishuClient:
             logger.debug("使用缓存的 token")
             return cached
 
-        url = f"{self.BASE_URL}/auth/v3/tenant_access_token/internal"
-        async with httpx.AsyncClient() as client:
-            resp = await client.post(url, json={
+        async with _token_cache.get_lock():
+            # 等锁期间可能已有其他协程刷新完成
+            cached = _token_cache.get()
+            if cached:
+                return cached
+
+            url = f"{self.BASE_URL}/auth/v3/tenant_access_token/internal"
+            resp = await self._post_with_retry(url, json={
                 "app_id": self.app_id,
                 "app_secret": self.app_secret
             })
@@ -500,33 +663,29 @@ class FeishuClient:
         payload = {
             "receive_id": receive_id,
             "msg_type": msg_type,
-            "content": json.dumps(content, ensure_ascii=False) if isinstance(content, dict) else content,
+            # 只序列化一次，重发时复用
+            "content": _json_dumps(content) if isinstance(content, dict) else content,
         }
 
-        # 带重试的请求
-        for attempt in range(3):
-            try:
-                async with httpx.AsyncClient(timeout=10.0) as client:
-                    resp = await client.post(url, headers=headers, json=payload)
-                    result = resp.json()
-                    if result.get("code") == 0:
-                        return result
-                    # 如果是 token 过期，尝试重新获取
-                    if result.get("code") in [99991663, 99991664]:  # token 相关错误码
-                        _token_cache._token = None  # 清除缓存
-                        token = await self.get_token()
-                        if token:
-                            headers["Authorization"] = f"Bearer {token}"
-                            continue
-                    logger.warning("发送失败 (尝试 {}): {}", attempt + 1, result)
-                    if attempt < 2:
-                        await asyncio.sleep(0.5 * (attempt + 1))
-            except Exception as e:
-                logger.warning("发送异常 (尝试 {}): {}", attempt + 1, e)
-                if attempt < 2:
-                    await asyncio.sleep(0.5 * (attempt + 1))
-
-        return {"code": -1, "msg": "发送失败，已重试 3 次"}
+        # 网络异常和限流由 _post_with_retry 退避重试；这里只处理 token 过期后的一次重发
+        try:
+            resp = await self._post_with_retry(url, headers=headers, json=payload)
+            result = resp.json()
+            if result.get("code") in [99991663, 99991664]:  # token 相关错误码
+                _token_cache.invalidate(token)  # 仅清除本次使用的过期 token
+                token = await self.get_token()
+                if not token:
+                    return {"code": -1, "msg": "token 已过期且重新获取失败"}
+                headers["Authorization"] = f"Bearer {token}"
+                resp = await self._post_with_retry(url, headers=headers, json=payload)
+                result = resp.json()
+        except Exception as e:
+            logger.warning("发送异常: {}", e)
+            return {"code": -1, "msg": f"发送失败: {e}"}
+
+        if result.get("code") != 0:
+            logger.warning("发送失败: {}", result)
+        return result
 
     async def upload_image(self, image_path: str) -> Optional[str]:
         """上传图片并返回 image_key"""
@@ -540,14 +699,13 @@ class FeishuClient:
         }
 
         try:
-            async with httpx.AsyncClient(timeout=30.0) as client:
-                with open(image_path, "rb") as f:
-                    files = {"image": f}
-                    data = {"image_type": "message"}
-                    resp = await client.post(url, headers=headers, files=files, data=data)
-                    result = resp.json()
-                    if result.get("code") == 0:
-                        return result.get("data", {}).get("image_key")
+            content = await _read_file_bytes(image_path)
+            files = {"image": (os.path.basename(image_path), content, "application/octet-stream")}
+            data = {"image_type": "message"}
+            resp = await self._post_with_retry(url, headers=headers, files=files, data=data, timeout=30.0)
+            result = resp.json()
+            if result.get("code") == 0:
+                return result.get("data", {}).get("image_key")
         except Exception as e:
             logger.error("上传图片失败: {}", e)
         return None
@@ -573,17 +731,16 @@ class FeishuClient:
         }
 
         try:
-            async with httpx.AsyncClient(timeout=60.0) as client:
-                with open(file_path, "rb") as f:
-                    files = {"file": (os.path.basename(file_path), f)}
-                    data = {"file_type": file_type}
-                    resp = await client.post(url, headers=headers, files=files, data=data)
-                    result = resp.json()
-                    if result.get("code") == 0:
-                        file_key = result.get("data", {}).get("file_key")
-                        logger.info(f"文件上传成功, file_key: {file_key}")
-                        return file_key
-                    logger.error("上传文件失败: {}", result)
+            content = await _read_file_bytes(file_path)
+            files = {"file": (os.path.basename(file_path), content)}
+            data = {"file_type": file_type}
+            resp = await self._post_with_retry(url, headers=headers, files=files, data=data, timeout=60.0)
+            result = resp.json()
+            if result.get("code") == 0:
+                file_key = result.get("data", {}).get("file_key")
+                logger.info(f"文件上传成功, file_key: {file_key}")
+                return file_key
+            logger.error("上传文件失败: {}", result)
         except Exception as e:
             logger.error("上传文件异常: {}", e)
         return None
@@ -600,7 +757,7 @@ class FeishuClient:
             "Content-Type": "application/json; charset=utf-8",
         }
 
-        content = json.dumps({"file_key": file_key}, ensure_ascii=False)
+        content = _json_dumps({"file_key": file_key})
         payload = {
             "receive_id": receive_id,
             "msg_type": "file",
@@ -608,9 +765,9 @@ class FeishuClient:
         }
 
         try:
-            async with httpx.AsyncClient(timeout=10.0) as client:
-                resp = await client.post(url, headers=headers, json=payload)
-                return resp.json()
+            client = await self._get_client()
+            resp = await client.post(url, headers=headers, json=payload)
+            return resp.json()
         except Exception as e:
             logger.error("发送文件消息失败: {}", e)
             return {"code": -1, "msg": str(e)}
@@ -627,13 +784,36 @@ class FeishuClient:
         }
 
         try:
-            async with httpx.AsyncClient(timeout=10.0) as client:
-                resp = await client.get(url, headers=headers)
-                return resp.json()
+            client = await self._get_client()
+            resp = await client.get(url, headers=headers)
+            return resp.json()
         except Exception as e:
             logger.error("获取消息失败: {}", e)
             return {"code": -1, "msg": str(e)}
 
+    async def get_end_user_id(self) -> Optional[Dict]:
+        """获取应用所属人员的 ID 信息（open_id / union_id），失败返回 None"""
+        token = await self.get_token()
+        if not token:
+            return None
+
+        url = f"{self.BASE_URL}/identity/v1/end_user/get_id"
+        headers = {
+            "Authorization": f"Bearer {token}",
+        }
+
+        try:
+            client = await self._get_client()
+            resp = await client.get(url, headers=headers)
+            if resp.status_code == 200:
+                result = resp.json()
+                if result.get("code") == 0:
+                    return result.get("data", {})
+            logger.warning("获取用户 ID 失败: HTTP {}", resp.status_code)
+        except Exception as e:
+            logger.warning("获取用户 ID 异常: {}", e)
+        return None
+
     async def get_chat_history(self, chat_id: str, limit: int = 20) -> Dict:
         """获取群聊历史消息"""
         token = await self.get_token()
@@ -651,9 +831,9 @@ class FeishuClient:
         }
 
         try:
-            async with httpx.AsyncClient(timeout=10.0) as client:
-                resp = await client.get(url, headers=headers, params=params)
-                return resp.json()
+            client = await self._get_client()
+            resp = await client.get(url, headers=headers, params=params)
+            return resp.json()
         except Exception as e:
             logger.error("获取群聊历史失败: {}", e)
             return {"code": -1, "msg": str(e)}
@@ -671,17 +851,17 @@ class FeishuClient:
         }
         payload = {
             "msg_type": msg_type,
-            "content": json.dumps(content, ensure_ascii=False) if isinstance(content, dict) else content,
+            "content": _json_dumps(content) if isinstance(content, dict) else content,
         }
 
         try:
-            async with httpx.AsyncClient(timeout=10.0) as client:
-                resp = await client.post(url, headers=headers, json=payload)
-                result = resp.json()
-                if result.get("code") == 0:
-                    return result
-                logger.warning("回复消息失败: {}", result)
+            client = await self._get_client()
+            resp = await client.post(url, headers=headers, json=payload)
+            result = resp.json()
+            if result.get("code") == 0:
                 return result
+            logger.warning("回复消息失败: {}", result)
+            return result
         except Exception as e:
             logger.error("回复消息异常: {}", e)
             return {"code": -1, "msg": str(e)}
@@ -698,9 +878,9 @@ class FeishuClient:
         }
 
         try:
-            async with httpx.AsyncClient(timeout=10.0) as client:
-                resp = await client.delete(url, headers=headers)
-                return resp.json()
+            client = await self._get_client()
+            resp = await client.delete(url, headers=headers)
+            return resp.json()
         except Exception as e:
             logger.error("撤回消息失败: {}", e)
             return {"code": -1, "msg": str(e)}
@@ -730,26 +910,15 @@ async def get_my_open_id() -> str:
     2. 在飞书开放平台应用管理中查看
     """
     client = get_feishu_client()
-    token = await client.get_token()
-    if not token:
+    if not await client.get_token():
         return "❌ 获取 token 失败"
 
     # 尝试调用获取用户 ID API
-    url = f"{client.BASE_URL}/identity/v1/end_user/get_id"
-    headers = {"Authorization": f"Bearer {token}"}
-
-    try:
-        async with httpx.AsyncClient() as http_client:
-            resp = await http_client.get(url, headers=headers)
-            if resp.status_code == 200:
-                result = resp.json()
-                if result.get("code") == 0:
-                    data = result.get("data", {})
-                    open_id = data.get("open_id", "未知")
-                    union_id = data.get("union_id", "未知")
-                    return f"✅ open_id: {open_id}\nunion_id: {union_id}"
-    except Exception as e:
-        pass
+    data = await client.get_end_user_id()
+    if data is not None:
+        open_id = data.get("open_id", "未知")
+        union_id = data.get("union_id", "未知")
+        return f"✅ open_id: {open_id}\nunion_id: {union_id}"
 
     # API 失败，返回获取方法
     return """❌ 无法通过 API 获取 open_id
@@ -830,6 +999,61 @@ async def send_feishu_reply(message: str, open_id: str = "", chat_id: str = "",
     return f"❌ 发送失败: {result.get('msg', result)}"
 
 
+# 批量发送的最大并发数（共享连接池，避免一次性打满飞书限流）
+BATCH_SEND_CONCURRENCY = 10
+
+
+@mcp.tool()
+async def send_feishu_reply_batch(message: str, open_ids: list[str], should_clean_markdown: bool = True) -> str:
+    """
+    将同一条文本消息并发发送给多个飞书用户。
+
+    Args:
+        message: 要发送的文本内容。
+        open_ids: 接收消息的用户 Open ID 列表。
+        should_clean_markdown: 是否清理 Markdown 符号（默认 true，避免 ** 加粗显示）
+    """
+    # 去重并保持顺序
+    targets = list(dict.fromkeys(oid.strip() for oid in open_ids if oid and oid.strip()))
+    if not targets:
+        return "❌ 错误：open_ids 为空"
+
+    rejected = [oid for oid in targets if not validate_open_id(oid)]
+    if rejected:
+        logger.warning(f"拒绝发送给未授权用户: {rejected}")
+        targets = [oid for oid in targets if oid not in rejected]
+    logger.info(f"[MCP调用] send_feishu_reply_batch - 发送给 {len(targets)} 个用户, 内容长度: {len(message)}")
+
+    if should_clean_markdown:
+        message = clean_markdown(message)
+
+    client = get_feishu_client()
+    content = {"text": message}
+    sem = asyncio.Semaphore(BATCH_SEND_CONCURRENCY)
+
+    async def _send_one(oid: str) -> Dict:
+        async with sem:
+            return await client.send_message(oid, "text", content)
+
+    results = await asyncio.gather(*(_send_one(oid) for oid in targets), return_exceptions=True)
+
+    failed = []
+    for oid, result in zip(targets, results):
+        if isinstance(result, BaseException):
+            failed.append(f"{oid}: {result}")
+        elif result.get("code") != 0:
+            failed.append(f"{oid}: {result.get('msg', result)}")
+    sent = len(targets) - len(failed)
+    logger.info("批量发送完成: 成功 {}, 失败 {}, 拒绝 {}", sent, len(failed), len(rejected))
+
+    lines = [f"{'✅' if not failed and not rejected else '⚠️'} 已成功发送给 {sent}/{len(targets) + len(rejected)} 个用户。"]
+    if rejected:
+        lines.append("不在白名单中: " + ", ".join(rejected))
+    if failed:
+        lines.append("发送失败:\n" + "\n".join(failed))
+    return "\n".join(lines)
+
+
 @mcp.tool()
 async def send_feishu_interaction_receipt(action_id: str, open_id: str = "", chat_id: str = "", content: str = "") -> str:
     """
@@ -909,22 +1133,12 @@ async def send_feishu_rich_text(title: str, content: str, open_id: str = "", cha
 
     # 构建富文本内容（正确的 post 消息格式）
     # 将 markdown 内容转换为飞书 post 格式的段落
-    lines = content.split('\n')
-    content_list = []
+    # 简单处理：将每个非空行作为一个文本段落
+    content_list = [[{"tag": "text", "text": line}] for line in content.split('\n') if line.strip()]
 
-    for line in lines:
-        if line.strip():
-            # 处理加粗 **text**
-            import re
-            # 简单处理：将整个行作为文本段落
-            content_list.append([{
-                "tag": "text",
-                "text": line
-            }])
-
-    # 如果没有内容，添加一个空段落
+    # 如果没有内容，使用一个空段落
     if not content_list:
-        content_list.append([{"tag": "text", "text": ""}])
+        content_list = _EMPTY_POST_CONTENT
 
     rich_text_content = {
         "zh_cn": {
@@ -962,9 +1176,14 @@ async def send_feishu_card(title: str, content: str,
         open_id: 接收消息的用户 Open ID（可选，不填则从环境变量读取）。
         chat_id: 接收消息的群聊 ID（可选，优先级高于 open_id）。
         card_type: 卡片类型 ("template" 模板卡片 或 "interactive" 交互卡片)。
-        template_color: 模板颜色 ("blue", "green", "red", "yellow", "grey")。
+        template_color: 模板颜色 ("blue", "green", "red", "yellow", "grey", "orange", "purple" 等)。
         actions: 按钮配置，JSON 格式字符串，如 '[{"tag":"button","text":{"tag":"plain_text","content":"确定"},"type":"primary","action_id":"confirm"}]'
     """
+    # 先规范化再本地校验颜色（容忍大小写/空白），避免无效参数白白请求一次飞书 API
+    template_color = (template_color or "blue").strip().lower()
+    if template_color not in _VALID_TEMPLATES:
+        return f"❌ 无效颜色: {template_color}（可选: {', '.join(sorted(_VALID_TEMPLATES))}）"
+
     # 优先使用 chat_id（群聊），其次使用 open_id（个人）
     if not chat_id:
         # 自动获取当前工作区的 chat_id
@@ -990,34 +1209,17 @@ async def send_feishu_card(title: str, content: str,
     client = get_feishu_client()
 
     # 构建卡片内容
-    card_content = {
-        "config": {
-            "wide_screen_mode": True
-        },
-        "header": {
-            "title": {
-                "tag": "plain_text",
-                "content": title
-            },
-            "template": template_color
-        },
-        "elements": [
-            {
-                "tag": "markdown",
-                "content": content
-            }
-        ]
-    }
+    card_content = _build_markdown_card(title, content, template_color)
 
     # 添加按钮（如果有）
     if actions:
         try:
-            actions_list = json.loads(actions)
+            actions_list = _json_loads(actions)
             card_content["elements"].append({
                 "tag": "action",
                 "actions": actions_list
             })
-        except json.JSONDecodeError:
+        except ValueError:  # json / orjson 的解析异常均继承自 ValueError
             logger.warning("actions JSON 解析失败，跳过按钮")
 
     # 发送到群聊或个人